@@ -0,0 +1,56 @@
+"""
+Comparison of the cloud detection computed at coarser resolutions with the one at full resolution,
+on a 13 bands Sentinel-2 L1C image (e.g. the output of mosaic.sentinel2.download).
+"""
+
+from argparse import ArgumentParser
+import time
+
+import numpy as np
+import rasterio
+
+from mosaic.clouddetection import Inference
+from mosaic.sentinel2 import RESOLUTION, NO_DATA
+
+def parse_arguments():
+
+    parser = ArgumentParser()
+    parser.add_argument("--image", type=str, required=True, help="Sentinel-2 L1C image with all the 13 bands")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[20, 60, 160], help="resolutions in meters to compare with the full resolution")
+    parser.add_argument("--threshold", type=float, default=0.4, help="cloud probability threshold of the mask")
+    args = parser.parse_args()
+    return(vars(args))
+
+
+def run(model, image):
+    start = time.perf_counter()
+    cloud_prob = model.predict(image)
+    return(cloud_prob, time.perf_counter() - start)
+
+
+def benchmark(image, resolutions, threshold):
+    with rasterio.open(image, 'r') as file:
+        bands = file.read().transpose((1,2,0))
+    valid = (bands != NO_DATA).all(-1)
+    bands[bands == NO_DATA] = 0
+    bands = bands.astype(np.float32)[np.newaxis, ...]/10000.0
+
+    reference, reference_time = run(Inference(all_bands=True), bands)
+    reference_mask = reference[0][valid] > threshold
+    print('resolution {:4d}m: {:8.2f}s, cloud cover {:.3f}'.format(RESOLUTION, reference_time, reference_mask.mean()))
+
+    for resolution in resolutions:
+        cloud_prob, elapsed = run(Inference(all_bands=True, resolution=resolution, image_resolution=RESOLUTION), bands)
+        mask = cloud_prob[0][valid] > threshold
+        agreement = (mask == reference_mask).mean()
+        union = (mask | reference_mask).sum()
+        iou = (mask & reference_mask).sum()/union if union > 0 else 1.0
+        print('resolution {:4d}m: {:8.2f}s, speedup {:7.1f}x, cloud cover {:.3f}, agreement {:.4f}, cloud IoU {:.4f}'.format(
+            resolution, elapsed, reference_time/elapsed, mask.mean(), agreement, iou
+        ))
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    benchmark(**args)
@@ -1,7 +1,6 @@
 
 from argparse import ArgumentParser
 import datetime
-import shutil
 
 import mosaic.sentinel1
 import mosaic.sentinel2
@@ -21,16 +20,51 @@ def parse_arguments():
     parser.add_argument("--end", type=str, default="2021/12/7", help="end date, in format year/month/day")
     parser.add_argument("--split_rows", type=int, default=10, help="bounding box splits in n rows")
     parser.add_argument("--split_columns", type=int, default=10, help="bounding box splits in n columns")
+    parser.add_argument("--auto_split", action="store_true", help="choose the smallest split of the bounding box allowed by the max request size, ignoring split_rows and split_columns")
+    parser.add_argument("--tile_size", type=int, default=None, help="max size in pixels of the tiles when using auto_split")
     parser.add_argument("--max_retry", type=int, default=10, help="maximimun number of requests for the same images")
     parser.add_argument("--output", type=str, default="./mosaic.tiff", help="output path")
-    parser.add_argument("--n", type=int, default=3, help="number of periods to use, when time is relevant")
+    parser.add_argument("--n", type=int, default=None, help="number of periods to use, when time is relevant (3 if not provided, with --update the periods have the length of the previous ones)")
     parser.add_argument("--rate_limit", type=int, default=300, help="max requests per minute")
+    parser.add_argument("--max_threads", type=int, default=4, help="max number of requests in flight at the same time")
+    parser.add_argument("--cache_dir", type=str, default=None, help="folder of the persistent tile cache, disabled if not provided")
+    parser.add_argument("--cache_size", type=float, default=10, help="max size of the tile cache, in GB")
+    parser.add_argument("--prune_tiles", action="store_true", help="do not request the tiles without any acquisition in the catalog (sentinel1, sentinel2, dwlulc, esalulc)")
+    parser.add_argument("--catalog_ttl", type=float, default=24, help="hours after which the cached catalog searches are repeated (sentinel1)")
+    parser.add_argument("--scratch_dir", type=str, default=None, help="folder of the intermediate files of the run, the system temporary folder if not provided")
+    parser.add_argument("--disk_budget", type=float, default=None, help="max size of the intermediate images waiting to be processed, in GB (sentinel1, sentinel2, dwlulc)")
+    parser.add_argument("--cog", action="store_true", help="write the output as a Cloud-Optimized GeoTIFF, compressed and with overviews")
+    parser.add_argument("--cog_blocksize", type=int, default=512, help="size in pixels of the internal tiles of the Cloud-Optimized GeoTIFF")
+    parser.add_argument("--cog_compress", type=str, choices=["DEFLATE", "LZW", "ZSTD", "LERC", "NONE"], default="DEFLATE", help="compression codec of the Cloud-Optimized GeoTIFF")
+    parser.add_argument("--cog_predictor", type=str, choices=["YES", "NO", "STANDARD", "FLOATING_POINT"], default="YES", help="predictor of the Cloud-Optimized GeoTIFF compression, YES to choose it from the data type")
+    parser.add_argument("--cube", type=str, default=None, help="folder of the [time, band, y, x] data cube storing every image of the time series, not stored if not provided (sentinel1, sentinel2, dwlulc). Without zarr (pip install .[cube]) the cube is an uncompressed .npy file")
+    parser.add_argument("--cube_chunk_size", type=int, default=512, help="size in pixels of the chunks of the data cube, when zarr is installed")
+    parser.add_argument("--compositing", type=str, choices=["mean", "median", "percentile", "best"], default="mean", help="temporal reduction of the images, best is the valid pixel with the lowest cloud probability (sentinel1, sentinel2, best only for sentinel2 with s2cloudless)")
+    parser.add_argument("--percentile", type=float, default=50, help="percentile of the valid observations, between 0 and 100, with --compositing percentile")
+    parser.add_argument("--keep_state", action="store_true", help="save the state of the composite next to the output, so that the mosaic can be updated (sentinel1, sentinel2)")
+    parser.add_argument("--update", action="store_true", help="add the images from the end of the previous run to --end to a mosaic created with --keep_state, keeping its bbox, bands and cloud mask (sentinel1, sentinel2)")
+    parser.add_argument("--resume", action="store_true", help="resume an interrupted run from its manifest")
+    parser.add_argument("--timestamp_requests", action="store_true", help="request each acquisition of an orbit group separately and merge them, instead of one request per tile for the whole group (sentinel1)")
+    parser.add_argument("--lulc_tile_size", type=int, default=None, help="run the land cover model on tiles of this size in pixels (dwlulc)")
+    parser.add_argument("--lulc_overlap", type=int, default=32, help="overlap in pixels between the tiles of the land cover model")
+    parser.add_argument("--lulc_batch_size", type=int, default=4, help="number of tiles predicted at once by the land cover model")
+    parser.add_argument("--min_observations", type=int, default=None, help="stop requesting the tiles where every pixel already has this number of valid observations (sentinel2)")
+    parser.add_argument("--queue_depth", type=int, default=1, help="number of time slots downloaded while the current one is processed, 0 to download and process them in sequence (sentinel1, sentinel2, dwlulc), always 0 with --min_observations")
+    parser.add_argument("--memory_budget", type=int, default=None, help="process the rasters block by block using at most this memory, in MB (sentinel1, sentinel2, esalulc)")
+    parser.add_argument("--bands", type=str, nargs="+", default=None, help="Sentinel-2 bands of the output, e.g. B02 B03 B04 B08, all the bands if not provided (sentinel2)")
+    parser.add_argument("--cloud_mask", type=str, choices=["s2cloudless", "CLP", "CLM"], default="s2cloudless", help="clouds detected locally by s2cloudless or masked by Sentinel Hub with its cloud probability (CLP) or cloud mask (CLM) (sentinel2, dwlulc)")
+    parser.add_argument("--cloud_chunk_size", type=int, default=None, help="run the cloud detection in chunks of this size in pixels (sentinel2, dwlulc)")
+    parser.add_argument("--cloud_overlap", type=int, default=16, help="overlap in pixels between the chunks of the cloud detection")
+    parser.add_argument("--cloud_workers", type=int, default=1, help="number of processes running the cloud detection chunks")
+    parser.add_argument("--cloud_resolution", type=int, default=None, help="resolution in meters of the cloud detection, e.g. 60 or 160, the image resolution if not provided")
 
     
     args = parser.parse_args()
     
     args.bbox = (args.minlong, args.minlat, args.maxlong, args.maxlat)
-    args.split_shape = (args.split_rows, args.split_columns)
+    args.split_shape = (args.split_columns, args.split_rows)  # sentinelhub expects (columns, rows)
+    if(args.auto_split):
+        args.split_shape = "auto"
 
     args.start = args.start.split("/")
     args.start = datetime.datetime(int(args.start[0]), int(args.start[1]), int(args.start[2]))
@@ -40,6 +74,19 @@ def parse_arguments():
     args.rate_limit = args.rate_limit*0.95
     args.rate_limit = 60/args.rate_limit
 
+    if(args.n is None and not args.update):
+        args.n = 3
+
+    args.group_requests = not args.timestamp_requests
+    del args.timestamp_requests
+
+    args.cache_size = int(args.cache_size*1024**3)
+    if(args.disk_budget is not None):
+        args.disk_budget = int(args.disk_budget*1024**3)
+    args.catalog_ttl = args.catalog_ttl*3600
+    if(args.memory_budget is not None):
+        args.memory_budget = args.memory_budget*1024**2
+
 
     del args.minlong
     del args.minlat
@@ -47,6 +94,7 @@ def parse_arguments():
     del args.maxlat
     del args.split_rows
     del args.split_columns
+    del args.auto_split
     
     args = vars(args)
     
@@ -59,11 +107,50 @@ if __name__ == "__main__":
 
     if args['image'] in ["esalulc", "copernicusdem"]:
         args.pop("n")    # not temporal
+        args.pop("disk_budget")
+        args.pop("queue_depth")
+        args.pop("cube")
+        args.pop("cube_chunk_size")
+
+    if args['image'] in ["dwlulc", "copernicusdem"]:
+        args.pop("memory_budget")    # not processed by blocks
+
+    if args['image'] != "sentinel2" or args['bands'] is None:
+        args.pop("bands")    # all the bands
+
+    if args['image'] != "sentinel2":
+        args.pop("min_observations")
+
+    if args['image'] != "sentinel1":
+        args.pop("group_requests")
+
+    if args['image'] not in ["sentinel1", "sentinel2"]:
+        args.pop("compositing")    # the mean of the class probabilities or a single map
+        args.pop("percentile")
+        args.pop("keep_state")
+        if args.pop("update"):
+            raise Exception("--update is supported only for sentinel1 and sentinel2")
+
+    if args['image'] == "copernicusdem":
+        args.pop("prune_tiles")    # not in the catalog
+        args.pop("catalog_ttl")
+
+    if args['image'] != "dwlulc":
+        args.pop("lulc_tile_size")
+        args.pop("lulc_overlap")
+        args.pop("lulc_batch_size")
+
+    if args['image'] not in ["sentinel2", "dwlulc"]:
+        args.pop("cloud_mask")    # no cloud detection
+        args.pop("cloud_chunk_size")
+        args.pop("cloud_overlap")
+        args.pop("cloud_workers")
+        args.pop("cloud_resolution")
 
     if args['image'] == "sentinel1":
-        from mosaic.sentinel1 import mosaic
+        from mosaic.sentinel1 import mosaic, update
     if args['image'] == "sentinel2":
-        from mosaic.sentinel2 import mosaic
+        from mosaic.sentinel2 import mosaic, update
     if args['image'] == "dwlulc":
         from mosaic.dwlulc import mosaic
     if args['image'] == "esalulc":
@@ -72,5 +159,13 @@ if __name__ == "__main__":
         from mosaic.copernicusdem import mosaic
 
     args.pop("image")
-    mosaic(**args)
-    shutil.rmtree("./test_dir")
+    if args.pop("update", False):
+        # the bbox and the parameters of the composite are the ones of the previous run
+        args.pop("bbox")
+        args.pop("start")
+        args.pop("keep_state")
+        args.pop("bands", None)
+        args.pop("cloud_mask", None)
+        update(**args)
+    else:
+        mosaic(**args)
@@ -0,0 +1,165 @@
+"""
+Persistent on-disk cache of the tiles downloaded from SentinelHub.
+Tiles are content-addressed: the key is computed from the collection, the evalscript,
+the tile bbox, the time interval, the resolution and the mosaicking order of the request.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+CACHE_SIZE = 10*1024**3  # bytes
+
+
+"""
+Key of the tile requested by a SentinelHubRequest.
+The resolution is represented by the size in pixels of the output, which together with the bbox identifies the grid.
+"""
+def tile_key(sh_request):
+    payload = sh_request.download_list[0].post_values
+    data = payload['input']['data'][0]
+    data_filter = dict(data.get('dataFilter', {}))
+
+    fields = {
+        'collection': data['type'],
+        'evalscript': hashlib.sha256(payload['evalscript'].encode('utf-8')).hexdigest(),
+        'bbox': payload['input']['bounds']['bbox'],
+        'crs': payload['input']['bounds']['properties']['crs'],
+        'time_interval': data_filter.pop('timeRange', None),
+        'mosaicking_order': data_filter.pop('mosaickingOrder', None),
+        'size': [payload['output']['width'], payload['output']['height']],
+        'data_filter': data_filter,
+        'processing': data.get('processing', {}),
+    }
+    fields = json.dumps(fields, sort_keys=True)
+    return(hashlib.sha256(fields.encode('utf-8')).hexdigest())
+
+
+class TileCache:
+    """
+    Size-bounded cache of tiffs stored in `folder`.
+    When the total size exceeds `max_bytes` the least recently used tiles are evicted.
+    Tiles returned by `get` and `put` are pinned, and they are not evicted until `unpin` is called.
+    """
+    def __init__(self, folder, max_bytes=CACHE_SIZE):
+        self.folder = os.path.abspath(folder)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pinned = {}
+        self.entries = OrderedDict()  # path -> size, from the least to the most recently used
+        self.size = 0
+        os.makedirs(self.folder, exist_ok=True)
+
+        entries = []
+        for root, _, files in os.walk(self.folder):
+            for file in files:
+                if(file.endswith('.tiff')):
+                    path = os.path.join(root, file)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        for _, size, path in sorted(entries):
+            self.entries[path] = size
+            self.size = self.size + size
+
+    """
+    Path of the tiff associated to a key.
+    """
+    def path(self, key):
+        return(os.path.join(self.folder, key[:2], key + '.tiff'))
+
+    """
+    Check if a path is stored in the cache.
+    """
+    def owns(self, path):
+        return(os.path.abspath(path).startswith(self.folder + os.sep))
+
+    """
+    Return the path of the cached tiff associated to the key, None if the tile is not in the cache.
+    """
+    def get(self, key):
+        path = self.path(key)
+        with self.lock:
+            if(not os.path.exists(path)):
+                self._discard(path)
+                return(None)
+            if(path not in self.entries):
+                self._add(path)  # stored by another process
+            os.utime(path)
+            self.entries.move_to_end(path)
+            self._pin(path)
+        return(path)
+
+    """
+    Move a downloaded tiff in the cache and return its new path.
+    """
+    def put(self, key, tiff):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.' + uuid.uuid4().hex + '.tmp'
+        shutil.move(tiff, tmp)
+        with self.lock:
+            os.replace(tmp, path)
+            self._discard(path)
+            self._add(path)
+            self._pin(path)
+            self._evict()
+        return(path)
+
+    """
+    Allow the eviction of a tiff previously returned by `get` or `put`.
+    """
+    def unpin(self, path):
+        with self.lock:
+            count = self.pinned.get(path, 0) - 1
+            if(count > 0):
+                self.pinned[path] = count
+            else:
+                self.pinned.pop(path, None)
+            self._evict()
+
+    def _pin(self, path):
+        self.pinned[path] = self.pinned.get(path, 0) + 1
+
+    def _add(self, path):
+        size = os.path.getsize(path)
+        self.entries[path] = size
+        self.size = self.size + size
+
+    def _discard(self, path):
+        size = self.entries.pop(path, None)
+        if(size is not None):
+            self.size = self.size - size
+
+    """
+    Remove the least recently used tiffs until the size of the cache is within the budget.
+    """
+    def _evict(self):
+        for path in list(self.entries.keys()):
+            if(self.size <= self.max_bytes):
+                break
+            if(path in self.pinned):
+                continue
+            self._discard(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+"""
+Return the TileCache shared by all the downloads using the same folder.
+"""
+def get_cache(folder, max_bytes=CACHE_SIZE):
+    folder = os.path.abspath(folder)
+    with _CACHES_LOCK:
+        if(folder not in _CACHES):
+            _CACHES[folder] = TileCache(folder, max_bytes=max_bytes)
+        _CACHES[folder].max_bytes = max_bytes
+        return(_CACHES[folder])
@@ -0,0 +1,111 @@
+"""
+Cache of the results of the SentinelHub Catalog searches.
+Results are kept in memory for the process and, if a folder is provided, in JSON files shared between runs.
+A result older than its time to live is searched again.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import numpy as np
+import pyproj
+import shapely
+import sentinelhub
+from sentinelhub import SentinelHubCatalog
+
+CATALOG_TTL = 24*3600  # seconds
+CRS = sentinelhub.CRS.WGS84
+
+_RESULTS = {}
+_RESULTS_LOCK = threading.Lock()
+
+
+"""
+Key of a search, computed from the collection (with its filters, e.g. the orbit direction), the bbox and the time interval.
+"""
+def search_key(collection, bbox, time_interval):
+    fields = {
+        'collection': collection.name,
+        'catalog_id': collection.catalog_id,
+        'bbox': list(bbox),
+        'crs': str(bbox.crs.epsg),
+        'time_interval': [str(t) for t in time_interval],
+    }
+    fields = json.dumps(fields, sort_keys=True)
+    return(hashlib.sha256(fields.encode('utf-8')).hexdigest())
+
+
+"""
+Results of a SentinelHubCatalog search, from the cache if they are not older than `ttl` seconds.
+If `folder` is provided, the results are also stored on disk in `folder`.
+"""
+def search(collection, bbox, time_interval, folder=None, ttl=CATALOG_TTL):
+    key = search_key(collection, bbox, time_interval)
+    now = time.time()
+
+    with _RESULTS_LOCK:
+        cached = _RESULTS.get(key)
+    if(cached is None and folder is not None):
+        path = os.path.join(folder, key + '.json')
+        if(os.path.exists(path)):
+            with open(path, 'r') as f:
+                cached = json.load(f)
+    if(cached is not None and now - cached['time'] < ttl):
+        return(cached['results'])
+
+    catalog = SentinelHubCatalog()
+    results = list(catalog.search(collection, bbox=bbox, time=time_interval))
+    cached = {'time': now, 'results': results}
+
+    with _RESULTS_LOCK:
+        _RESULTS[key] = cached
+    if(folder is not None):
+        os.makedirs(folder, exist_ok=True)
+        tmp = os.path.join(folder, '{key}.{uuid}.tmp'.format(key=key, uuid=uuid.uuid4().hex))
+        with open(tmp, 'w') as f:
+            json.dump(cached, f)
+        os.replace(tmp, os.path.join(folder, key + '.json'))
+    return(results)
+
+
+"""
+Footprints of the catalog results as shapely geometries in WGS84, reprojected one CRS at a time.
+"""
+def get_footprints(results):
+    footprints = np.array([shapely.geometry.shape(result['geometry']) for result in results], dtype=object)
+    crs_names = np.array([result['geometry']['crs']['properties']['name'] for result in results])
+
+    for crs_name in np.unique(crs_names):
+        crs = sentinelhub.CRS(crs_name)
+        if(crs == CRS):
+            continue
+        transformer = pyproj.Transformer.from_crs(crs.pyproj_crs(), CRS.pyproj_crs(), always_xy=True)
+        selected = crs_names == crs_name
+        footprints[selected] = shapely.transform(
+            footprints[selected], lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1]))
+        )
+    return(footprints)
+
+
+"""
+Area covered by the acquisitions of the collection in the time interval, as a shapely geometry in WGS84.
+"""
+def get_coverage(collection, bbox, time_interval, folder=None, ttl=CATALOG_TTL):
+    results = search(collection, bbox, time_interval, folder=folder, ttl=ttl)
+    if(len(results) == 0):
+        return(shapely.Polygon())
+    return(shapely.union_all(get_footprints(results)))
+
+
+"""
+Tiles (BBox in WGS84) intersecting the covered area, the others would be empty and are not requested.
+"""
+def prune_tiles(bbox_list, coverage):
+    tiles = np.array([shapely.box(*list(tile)) for tile in bbox_list], dtype=object)
+    keep = shapely.intersects(tiles, coverage) & ~shapely.touches(tiles, coverage)
+    if(not keep.all()):
+        print("{n} of {total} tiles are not covered by any acquisition and are not requested".format(n = int((~keep).sum()), total = len(bbox_list)))
+    return([tile for tile, k in zip(bbox_list, keep) if k])
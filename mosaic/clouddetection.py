@@ -2,20 +2,197 @@
 Cloud detection wrapper
 """
 
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from affine import Affine
+from rasterio.warp import reproject, Resampling
 from s2cloudless import S2PixelCloudDetector
+from mosaic.raster import DEFAULT_CRS
+
+
+"""
+s2cloudless model, loaded once per process and shared by all the Inference objects.
+"""
+@functools.lru_cache(maxsize=None)
+def _get_model(all_bands):
+    return(S2PixelCloudDetector(threshold=None, average_over=0, dilation_size=0, all_bands=all_bands))
+
+
+_WORKER = {}
+
+"""
+Resample an array of shape [N, H, W, ...] to the given [H, W], with the pixels of both arrays covering the same area.
+"""
+def _resample(array, shape, resampling):
+    height, width = shape
+    src_transform = Affine.scale(1/array.shape[2], -1/array.shape[1])
+    dst_transform = Affine.scale(1/width, -1/height)
+
+    source = np.moveaxis(array.reshape(array.shape[:3] + (-1,)), -1, 1).astype(np.float32)
+    output = np.empty(source.shape[:2] + (height, width), dtype=np.float32)
+    for i in range(source.shape[0]):
+        reproject(
+            source=source[i],
+            destination=output[i],
+            src_transform=src_transform,
+            src_crs=DEFAULT_CRS,
+            dst_transform=dst_transform,
+            dst_crs=DEFAULT_CRS,
+            resampling=resampling,
+        )
+    output = np.moveaxis(output, 1, -1)
+    return(output.reshape(output.shape[:3] + array.shape[3:]))
+
+
+"""
+Initialization of a worker of the process pool: the model is loaded once for the lifetime of the pool.
+"""
+def _init_worker(all_bands):
+    _WORKER['model'] = _get_model(all_bands)
+
+
+"""
+Input and output arrays in shared memory, so that chunks are never pickled.
+They are attached once and attached again only when the buffers of the Inference change.
+"""
+def _attach(image_name, image_shape, output_name, output_shape):
+    if(_WORKER.get('names') != (image_name, output_name)):
+        for name in ['image', 'output']:
+            if(name + '_shm' in _WORKER):
+                del _WORKER[name]
+                _WORKER.pop(name + '_shm').close()
+        _WORKER['image_shm'] = shared_memory.SharedMemory(name=image_name)
+        _WORKER['output_shm'] = shared_memory.SharedMemory(name=output_name)
+        _WORKER['names'] = (image_name, output_name)
+    _WORKER['image'] = np.ndarray(image_shape, dtype=np.float32, buffer=_WORKER['image_shm'].buf)
+    _WORKER['output'] = np.ndarray(output_shape, dtype=np.float32, buffer=_WORKER['output_shm'].buf)
+
+
+"""
+Prediction of a chunk, the chunk is extended by the overlap and only its core is written in the output.
+"""
+def _predict_chunk(model, image, output, chunk, overlap, **kwargs):
+    row, col, height, width = chunk
+    top, left = max(0, row - overlap), max(0, col - overlap)
+    bottom, right = min(image.shape[1], row + height + overlap), min(image.shape[2], col + width + overlap)
+
+    cloud_prob = model.get_cloud_probability_maps(image[:, top:bottom, left:right, :], **kwargs)
+    output[:, row:row+height, col:col+width] = cloud_prob[:, row-top:row-top+height, col-left:col-left+width]
+
+
+def _predict_chunk_worker(buffers, chunk, overlap):
+    _attach(*buffers)
+    # parallelism comes from the pool, a single LightGBM thread per worker avoids oversubscription
+    _predict_chunk(_WORKER['model'], _WORKER['image'], _WORKER['output'], chunk, overlap, num_threads=1)
+
 
 class Inference:
     """
-    Extraction of a cloud mask from a Sentinel-2 image in input. 
+    Extraction of a cloud mask from a Sentinel-2 image in input.
     The wrapper is using s2cloudless: https://github.com/sentinel-hub/sentinel2-cloud-detector
+    If `chunk_size` is provided, the image is split in chunks of `chunk_size` x `chunk_size` pixels
+    (extended by `overlap` pixels on each side) processed by a pool of `workers` processes,
+    with the image and the probabilities shared through shared memory.
+    The pool and the shared memory are kept between the calls of predict (the buffers are allocated again
+    only for images of a different shape), they are released by close.
+    If `resolution` (in meters) is coarser than the `image_resolution`, the probabilities are computed
+    on the image averaged at `resolution` and upsampled back to the grid of the image.
     """
-    def __init__(self, all_bands=False):
-        self.model = S2PixelCloudDetector(threshold=None, average_over=0, dilation_size=0, all_bands=all_bands)
-    
+    def __init__(self, all_bands=False, chunk_size=None, overlap=0, workers=1, resolution=None, image_resolution=10):
+        self.all_bands = all_bands
+        self.resolution = resolution
+        self.image_resolution = image_resolution
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.workers = workers
+        self.model = _get_model(all_bands)
+        self.executor = None
+        self.image_shm = None
+        self.output_shm = None
+        self.shape = None
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    """
+    Shut down the pool of workers and release the shared memory.
     """
-    image is expected to be of shape [N, H, W, 13] with all the Sentinel-2 Bands if 
+    def close(self):
+        if(getattr(self, 'executor', None) is not None):
+            self.executor.shutdown()
+            self.executor = None
+        self._release()
+
+    def _release(self):
+        for shm in [getattr(self, 'image_shm', None), getattr(self, 'output_shm', None)]:
+            if(shm is not None):
+                shm.close()
+                shm.unlink()
+        self.image_shm = None
+        self.output_shm = None
+        self.shape = None
+
+    """
+    Shared memory for images of the given shape, allocated again only if the shape changes.
+    """
+    def _buffers(self, shape):
+        if(self.shape != shape):
+            self._release()
+            self.image_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape))*4)
+            self.output_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape[:3]))*4)
+            self.shape = shape
+        image = np.ndarray(shape, dtype=np.float32, buffer=self.image_shm.buf)
+        output = np.ndarray(shape[:3], dtype=np.float32, buffer=self.output_shm.buf)
+        return(image, output)
+
+    """
+    image is expected to be of shape [N, H, W, 13] with all the Sentinel-2 Bands if
     self.all_bands = True otherwise [N, H, W, C] with the bands required by s2cloudless
     """
     def predict(self, image):
-        cloud_prob = self.model.get_cloud_probability_maps(image)
-        return(cloud_prob)
\ No newline at end of file
+        if(self.resolution is None or self.resolution <= self.image_resolution):
+            return(self._predict(image))
+
+        factor = self.resolution/self.image_resolution
+        shape = (max(1, int(round(image.shape[1]/factor))), max(1, int(round(image.shape[2]/factor))))
+        cloud_prob = self._predict(_resample(image, shape, Resampling.average))
+        cloud_prob = _resample(cloud_prob, image.shape[1:3], Resampling.bilinear)
+        return(cloud_prob)
+
+    def _predict(self, image):
+        if(self.chunk_size is None):
+            cloud_prob = self.model.get_cloud_probability_maps(image)
+            return(cloud_prob)
+
+        chunks = [
+            (row, col, min(self.chunk_size, image.shape[1] - row), min(self.chunk_size, image.shape[2] - col))
+            for row in range(0, image.shape[1], self.chunk_size)
+            for col in range(0, image.shape[2], self.chunk_size)
+        ]
+
+        if(self.workers <= 1 or len(chunks) == 1):
+            cloud_prob = np.empty(image.shape[:3], dtype=np.float32)
+            for chunk in chunks:
+                _predict_chunk(self.model, image, cloud_prob, chunk, self.overlap)
+            return(cloud_prob)
+
+        shared_image, shared_output = self._buffers(tuple(image.shape))
+        shared_image[...] = image
+        if(self.executor is None):
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self.all_bands,))
+
+        buffers = (self.image_shm.name, image.shape, self.output_shm.name, image.shape[:3])
+        futures = [self.executor.submit(_predict_chunk_worker, buffers, chunk, self.overlap) for chunk in chunks]
+        for future in futures:
+            future.result()
+        cloud_prob = shared_output.copy()
+        del shared_image, shared_output
+        return(cloud_prob)
@@ -0,0 +1,144 @@
+"""
+Temporal compositing of multiple images of the same area.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+COUNT_DTYPE = np.uint16
+MAX_IMAGES = np.iinfo(COUNT_DTYPE).max
+STATE = 'state.json'
+
+
+class Compositor:
+    """
+    Running per-pixel mean of a sequence of images of shape [C, H, W].
+    The sum is kept in a wide type (int32 for integer images, float32 for floating point images),
+    while the number of valid observations is a single uint16 count per pixel, shared by all the bands.
+    At most 65535 images can be added (the int32 sum of as many int16 images does not overflow),
+    also over the runs adding images to a saved state.
+    If `folder` is provided, the state is memory-mapped on disk instead of being kept in RAM,
+    so that images can be composited one window at a time with constant memory.
+    If `keep_sum` is False, only the count of the valid observations is kept (no mean can be computed).
+    """
+    def __init__(self, folder=None, keep_sum=True):
+        self.folder = folder
+        self.keep_sum = keep_sum
+        self.sum = None
+        self.count = None
+        self.n = 0
+
+    """
+    Allocate the state for images of the given shape and type.
+    It is required before adding the first image one window at a time.
+    """
+    def allocate(self, shape, dtype):
+        dtype = np.int32 if np.issubdtype(dtype, np.integer) else np.float32
+        if(self.folder is None):
+            if(self.keep_sum):
+                self.sum = np.zeros(shape, dtype=dtype)
+            self.count = np.zeros(shape[1:], dtype=COUNT_DTYPE)
+        else:
+            os.makedirs(self.folder, exist_ok=True)
+            self.tmp = tempfile.TemporaryDirectory(dir=self.folder)
+            if(self.keep_sum):
+                self.sum = np.lib.format.open_memmap(os.path.join(self.tmp.name, 'sum.npy'), mode='w+', dtype=dtype, shape=shape)
+            self.count = np.lib.format.open_memmap(os.path.join(self.tmp.name, 'count.npy'), mode='w+', dtype=COUNT_DTYPE, shape=shape[1:])
+
+    """
+    Add an image to the composite, `valid` is a [H, W] boolean array which is True for the pixels to use.
+    If `window` is provided, `bands` and `valid` cover only that window of the composite.
+    The number of images is incremented by `next_image`, to be called once all the windows of an image are added.
+    """
+    def add(self, bands, valid, window=None):
+        if(self.count is None):
+            self.allocate(bands.shape, bands.dtype)
+        if(self.n >= MAX_IMAGES):
+            raise Exception(f'Compositor supports at most {MAX_IMAGES} images, the mosaic has to be created again from a later start')
+
+        rows, cols = self._slices(window)
+        if(self.sum is not None):
+            np.add(self.sum[:, rows, cols], bands, out=self.sum[:, rows, cols], where=valid[np.newaxis, ...])
+        np.add(self.count[rows, cols], valid, out=self.count[rows, cols])
+        if(window is None):
+            self.next_image()
+
+    """
+    Mark the end of an image added one window at a time.
+    """
+    def next_image(self):
+        self.n = self.n + 1
+
+    """
+    Per-pixel mean of the valid observations, with `nodata` where a pixel has no valid observation.
+    The result is computed one band at a time, so that no full-size temporary array is allocated.
+    If `window` is provided, only that window of the composite is computed.
+    """
+    def mean(self, nodata, dtype=np.float32, window=None):
+        rows, cols = self._slices(window)
+        count = self.count[rows, cols]
+        result = np.empty((self.sum.shape[0],) + count.shape, dtype=dtype)
+        valid = count > 0
+        count = np.maximum(count, 1)
+        for band in range(self.sum.shape[0]):
+            mean = self.sum[band, rows, cols]/count
+            mean[~valid] = nodata
+            result[band] = mean
+        return(result)
+
+    """
+    Save the state of the composite in `folder` (replaced as a whole), with the `metadata` describing
+    the images added so far, such that later images can be added to it by another run.
+    """
+    def save(self, folder, metadata=None):
+        tmp = folder + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'sum.npy'), self.sum)
+        np.save(os.path.join(tmp, 'count.npy'), self.count)
+        with open(os.path.join(tmp, STATE), 'w') as f:
+            json.dump({'n': self.n, 'metadata': metadata}, f, default=str)
+
+        old = folder + '.old'
+        if(os.path.exists(folder)):
+            os.replace(folder, old)
+        os.replace(tmp, folder)
+        shutil.rmtree(old, ignore_errors=True)
+
+    """
+    Load the state saved in `folder`, returning its metadata.
+    """
+    def load(self, folder):
+        with open(os.path.join(folder, STATE), 'r') as f:
+            state = json.load(f)
+        total = np.load(os.path.join(folder, 'sum.npy'), mmap_mode='r')
+        self.allocate(total.shape, total.dtype)
+        self.sum[...] = total
+        self.count[...] = np.load(os.path.join(folder, 'count.npy'), mmap_mode='r')
+        self.n = state['n']
+        return(state['metadata'])
+
+    def _slices(self, window):
+        if(window is None):
+            return(slice(None), slice(None))
+        return(window.toslices())
+
+
+"""
+Folder of the state of the composite saved next to `output`.
+"""
+def get_state_path(output):
+    return(output + '.state')
+
+
+"""
+Metadata of the state saved in `folder`, without loading the composite.
+"""
+def read_state(folder):
+    if(not os.path.exists(os.path.join(folder, STATE))):
+        raise Exception(f'No composite state in {folder}, the mosaic has to be created with keep_state')
+    with open(os.path.join(folder, STATE), 'r') as f:
+        return(json.load(f)['metadata'])
@@ -10,21 +10,25 @@ from mosaic import evalscripts
 import rasterio
 import numpy as np
 import datetime
-from mosaic.utils import shretry, gdal_merge
-import time
+from mosaic.downloader import get_downloader
+from mosaic.cache import CACHE_SIZE
+from mosaic.manifest import RunManifest
+from mosaic.scratch import get_scratch
+from mosaic.raster import TileWriter, write_cog, BLOCK_SIZE, COMPRESS, PREDICTOR
+from mosaic.utils import resolve_split_shape
 
 
 NO_DATA = -9999
 RESOLUTION = 10
 CRS = sentinelhub.CRS.WGS84
 
-def download(bbox, time_interval, output, split_shape, rate_limit):
+def download(bbox, time_interval, output, split_shape, rate_limit, max_threads=4, cache_dir=None, cache_size=CACHE_SIZE, max_retry=10, manifest=None, tile_size=None, data_folder="test_dir"):
 
 
     def get_image(bbox, resolution):
         size = bbox_to_dimensions(bbox, resolution=resolution)
         request = SentinelHubRequest(
-            data_folder="test_dir",
+            data_folder=data_folder,
             evalscript=evalscripts.DEM_COPERNICUS_30,
             input_data=[
                 SentinelHubRequest.input_data(
@@ -41,6 +45,7 @@ def download(bbox, time_interval, output, split_shape, rate_limit):
         return(request)
     
 
+    split_shape = resolve_split_shape(bbox, split_shape, RESOLUTION, tile_size)
     bbox_splitter = BBoxSplitter(
         [ BBox(bbox, crs=CRS) ], crs = CRS, split_shape = split_shape
     )  # bounding box will be split into grid of rows x columns bounding boxes
@@ -49,36 +54,26 @@ def download(bbox, time_interval, output, split_shape, rate_limit):
     bbox_list = bbox_splitter.get_bbox_list()
     sh_requests = [get_image(bbox, RESOLUTION) for bbox in bbox_list]
     
-    #dl_requests = [request.download_list[0] for request in sh_requests]
-    #_ = SentinelHubDownloadClient(config=None).download(dl_requests, max_threads=5)
+    downloader = get_downloader(rate_limit, max_threads, cache_dir, cache_size)
+    with TileWriter(output, bbox, RESOLUTION, nodata=NO_DATA, dtype=np.float32, count=1) as writer:
+        downloader.download_into(sh_requests, writer, max_retry=max_retry, manifest=manifest)
 
-    for request in sh_requests:
-        dl_request = request.download_list[0]
-        _ = SentinelHubDownloadClient(config=None).download([dl_request], max_threads=1)
-        time.sleep(rate_limit)  # Pause for the specified time delay
 
-    data_folder = sh_requests[0].data_folder
-    tiffs = [Path(data_folder) / req.get_filename_list()[0] for req in sh_requests]
-    str_tiffs = [str(tiff) for tiff in tiffs]
-    gdal_merge(str_tiffs, bbox, output=output, dstnodata=NO_DATA)
+def mosaic(bbox, start, end, output, max_retry = 10, split_shape=(10,10), rate_limit=1, max_threads=4, cache_dir=None, cache_size=CACHE_SIZE, resume=False, tile_size=None, scratch_dir=None, cog=False, cog_blocksize=BLOCK_SIZE, cog_compress=COMPRESS, cog_predictor=PREDICTOR):
 
+    split_shape = resolve_split_shape(bbox, split_shape, RESOLUTION, tile_size)
 
-def mosaic(bbox, start, end, output, max_retry = 10, split_shape=(10,10), rate_limit=1):
+    manifest = None
+    if(resume):
+        manifest = RunManifest(output + '.manifest.json', {'bbox': list(bbox), 'start': start, 'end': end, 'split_shape': split_shape})
 
-    shretry(max_retry, download, bbox = bbox, time_interval=(start, end), output = output, split_shape = split_shape, rate_limit=rate_limit)
+    # the tiles are downloaded in the scratch space of the run
+    # with `cog`, the DEM is written in the scratch space and copied to a Cloud-Optimized GeoTIFF
+    with get_scratch(output, scratch_dir, resume=resume) as scratch:
+        dem = scratch.path('dem.tiff') if cog else output
+        download(bbox = bbox, time_interval=(start, end), output = dem, split_shape = split_shape, rate_limit=rate_limit, max_threads=max_threads, cache_dir=cache_dir, cache_size=cache_size, max_retry=max_retry, manifest=manifest, data_folder=scratch.path('tiles'))
+        if(cog):
+            write_cog(dem, output, blocksize=cog_blocksize, compress=cog_compress, predictor=cog_predictor, resampling='average')
 
-    with rasterio.open(output, 'r') as file:
-        bands = file.read()
-        mask  = bands[-1,  :, :]
-        bands = bands[:-1, :, :]
-        profile = file.profile
-
-    profile.update(count = bands.shape[0])
-    with rasterio.open(output, 'w', **profile) as file:
-
-        bands = np.array(bands).transpose((1,2,0))
-        bands[mask==0] = NO_DATA
-        bands = np.array(bands).transpose((2,0,1))
-
-        file.nodata = NO_DATA
-        file.write(bands)
\ No newline at end of file
+    if(manifest is not None):
+        manifest.remove()
\ No newline at end of file
@@ -0,0 +1,234 @@
+"""
+Time series of the images of a mosaic, stored as a [time, band, y, x] data cube.
+The cube is a chunked and compressed Zarr array when zarr is installed, otherwise a memory-mapped .npy file.
+Both are read lazily, one window at a time.
+"""
+
+import json
+import os
+import numpy as np
+from mosaic.raster import BLOCK_SIZE
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+METADATA = 'cube.json'
+NPY = 'cube.npy'  # without zarr
+ZARR = 'cube.zarr'
+COMPOSITING = ['mean', 'median', 'percentile', 'best']
+
+
+class DataCube:
+    """
+    Data cube of shape [T, C, H, W] in the folder `path`, with one image of shape [C, H, W] per element of `times`.
+    Images are written (one window at a time if needed) as they are produced, the pixels never written are `nodata`.
+    With zarr, the cube is chunked in blocks of one band of one image of `chunk_size` x `chunk_size` pixels.
+    `attrs` is a dictionary of metadata stored with the cube (e.g. the transform and the band names).
+    """
+    def __init__(self, path, times, shape, dtype, nodata, chunk_size=BLOCK_SIZE, attrs=None):
+        self.path = path
+        self.times = [list(time) if isinstance(time, (list, tuple)) else time for time in times]
+        self.nodata = nodata
+        self.attrs = attrs or {}
+        self.written = [False]*len(self.times)
+        self.mode = 'w'
+
+        os.makedirs(path, exist_ok=True)
+        shape = (len(self.times),) + tuple(shape)
+        if(zarr is not None):
+            self.data = zarr.open_array(
+                store=os.path.join(path, ZARR),
+                mode='w',
+                shape=shape,
+                chunks=(1, 1, chunk_size, chunk_size),
+                dtype=dtype,
+                fill_value=nodata,
+            )
+        else:
+            print('zarr is not installed, the data cube {path} is stored uncompressed (pip install .[cube] to compress it)'.format(path = path))
+            self.data = np.lib.format.open_memmap(os.path.join(path, NPY), mode='w+', dtype=dtype, shape=shape)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def shape(self):
+        return(tuple(self.data.shape))
+
+    """
+    Write the image of time `index`, if `window` is provided `bands` cover only that window of the image.
+    """
+    def write(self, index, bands, window=None):
+        rows, cols = self._slices(window)
+        self.data[index, :, rows, cols] = bands
+        self.written[index] = True
+
+    """
+    Images of the cube in the window (the whole image if not provided), of shape [T, C, h, w].
+    If `times` is provided, only the images with these indices are read.
+    """
+    def read(self, window=None, times=None):
+        rows, cols = self._slices(window)
+        if(times is None):
+            return(np.asarray(self.data[:, :, rows, cols]))
+        return(np.stack([np.asarray(self.data[index, :, rows, cols]) for index in times]))
+
+    """
+    Per-pixel mean of the valid observations, with `nodata` where a pixel has no valid observation.
+    As in the Compositor, an observation is valid if none of its bands is nodata.
+    """
+    def mean(self, nodata, dtype=np.float32, window=None):
+        rows, cols = self._slices(window)
+        height, width = self.shape[2:]
+        height, width = len(range(height)[rows]), len(range(width)[cols])
+        total = np.zeros((self.shape[1], height, width), dtype=np.float64)
+        count = np.zeros((height, width), dtype=np.int32)
+        for index in self._written():
+            bands = np.asarray(self.data[index, :, rows, cols])
+            valid = self._valid(bands)
+            np.add(total, bands, out=total, where=valid[np.newaxis, ...])
+            count = count + valid
+
+        result = (total/np.maximum(count, 1)).astype(dtype)
+        result[:, count == 0] = nodata
+        return(result)
+
+    """
+    Per-pixel `q`-th percentile (between 0 and 100) of the valid observations, with `nodata` where a pixel
+    has no valid observation. All the images of the window are read, so the window has to fit in memory.
+    """
+    def percentile(self, q, nodata, dtype=np.float32, window=None):
+        stack = self._stack(window)
+        if(stack is None):
+            return(self._empty(nodata, dtype, window))
+        bands, valid = stack
+
+        # the valid observations are sorted first, the percentile is interpolated linearly between
+        # the two closest ones as in np.percentile (np.nanpercentile is much slower)
+        bands = bands.astype(np.float32)
+        bands[~np.broadcast_to(valid[:, np.newaxis, ...], bands.shape)] = np.inf
+        bands.sort(axis=0)
+        count = valid.sum(0)
+        position = (np.maximum(count, 1) - 1)*q/100.0
+        lower = np.floor(position).astype(np.intp)
+        upper = np.minimum(lower + 1, np.maximum(count - 1, 0))
+        low = np.take_along_axis(bands, lower[np.newaxis, np.newaxis, ...], axis=0)[0]
+        high = np.take_along_axis(bands, upper[np.newaxis, np.newaxis, ...], axis=0)[0]
+        with np.errstate(invalid='ignore'):  # pixels without valid observations
+            result = low + (high - low)*(position - lower)
+        result[:, count == 0] = nodata
+        return(result.astype(dtype))
+
+    """
+    Per-pixel valid observation with the lowest score, the scores are a cube of shape [T, 1, H, W]
+    (e.g. the cloud probability), with nodata where a pixel has no valid observation.
+    """
+    def best(self, scores, nodata, dtype=np.float32, window=None):
+        stack = self._stack(window)
+        if(stack is None):
+            return(self._empty(nodata, dtype, window))
+        bands, valid = stack
+
+        # a valid observation without score is chosen only if there is no other valid observation
+        score = scores.read(window, times=self._written())[:, 0].astype(np.float32)
+        score[np.isnan(score)] = np.finfo(np.float32).max
+        best = np.argmin(np.where(valid, score, np.inf), axis=0)
+        result = np.take_along_axis(bands, best[np.newaxis, np.newaxis, ...], axis=0)[0].astype(dtype)
+        result[:, ~valid.any(0)] = nodata
+        return(result)
+
+    """
+    Composite of the cube with one of the COMPOSITING methods, `q` is the percentile of the 'percentile' method
+    and `scores` the cube of the scores of the 'best' method.
+    """
+    def composite(self, method, nodata, dtype=np.float32, window=None, q=50, scores=None):
+        if(method == 'mean'):
+            return(self.mean(nodata, dtype, window))
+        if(method == 'median'):
+            return(self.percentile(50, nodata, dtype, window))
+        if(method == 'percentile'):
+            return(self.percentile(q, nodata, dtype, window))
+        if(method == 'best'):
+            return(self.best(scores, nodata, dtype, window))
+        raise Exception(f'Unknown compositing {method}, expected one of {COMPOSITING}')
+
+    """
+    Mark the images never written as nodata and store the metadata, the cube can then be read with open_cube.
+    """
+    def close(self):
+        if(self.mode == 'r'):
+            return
+        if(isinstance(self.data, np.memmap)):
+            for index, written in enumerate(self.written):
+                if(not written):
+                    self.data[index] = self.nodata
+            self.data.flush()
+        metadata = {'times': self.times, 'nodata': _to_json(self.nodata), 'written': self.written, 'attrs': self.attrs}
+        with open(os.path.join(self.path, METADATA), 'w') as f:
+            json.dump(metadata, f, default=str)
+
+    def _written(self):
+        return([index for index, written in enumerate(self.written) if written])
+
+    """
+    Images written in the window, of shape [T, C, h, w], and their [T, h, w] valid observations.
+    """
+    def _stack(self, window):
+        times = self._written()
+        if(len(times) == 0):
+            return(None)
+        bands = self.read(window, times=times)
+        return(bands, np.stack([self._valid(image) for image in bands]))
+
+    def _empty(self, nodata, dtype, window):
+        rows, cols = self._slices(window)
+        height, width = self.shape[2:]
+        return(np.full((self.shape[1], len(range(height)[rows]), len(range(width)[cols])), nodata, dtype=dtype))
+
+    def _valid(self, bands):
+        if(self.nodata is None):
+            return(np.ones(bands.shape[1:], dtype=bool))
+        if(isinstance(self.nodata, float) and np.isnan(self.nodata)):
+            return(~np.isnan(bands).any(0))
+        return((bands != self.nodata).all(0))
+
+    def _slices(self, window):
+        if(window is None):
+            return(slice(None), slice(None))
+        return(window.toslices())
+
+
+def _to_json(value):
+    if(isinstance(value, np.generic)):
+        value = value.item()
+    if(isinstance(value, float) and np.isnan(value)):
+        return('nan')
+    return(value)
+
+
+"""
+Open the data cube in `path` for lazy reads.
+"""
+def open_cube(path):
+    with open(os.path.join(path, METADATA), 'r') as f:
+        metadata = json.load(f)
+
+    cube = DataCube.__new__(DataCube)
+    cube.path = path
+    cube.times = metadata['times']
+    cube.nodata = float('nan') if metadata['nodata'] == 'nan' else metadata['nodata']
+    cube.attrs = metadata['attrs']
+    cube.written = metadata['written']
+    cube.mode = 'r'
+    if(os.path.exists(os.path.join(path, NPY))):
+        cube.data = np.load(os.path.join(path, NPY), mmap_mode='r')
+    elif(zarr is not None):
+        cube.data = zarr.open_array(store=os.path.join(path, ZARR), mode='r')
+    else:
+        raise Exception(f'zarr is required to read the data cube {path}')
+    return(cube)
@@ -0,0 +1,174 @@
+"""
+Concurrent download of the tiles requested to SentinelHub.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from sentinelhub import SentinelHubDownloadClient, SHConfig
+from mosaic.cache import CACHE_SIZE, get_cache, tile_key
+from mosaic.utils import backoff_retry
+import os
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the threads of the Downloaders using the same account.
+    A token is added every `rate_limit` seconds, up to `burst` tokens, and every request consumes one token.
+    """
+    def __init__(self, rate_limit=1, burst=1):
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.tokens = burst
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    """
+    Block the calling thread until a token is available, then consume it.
+    """
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if(self.rate_limit > 0):
+                    self.tokens = min(self.burst, self.tokens + (now - self.timestamp)/self.rate_limit)
+                else:
+                    self.tokens = self.burst
+                self.timestamp = now
+
+                if(self.tokens >= 1):
+                    self.tokens = self.tokens - 1
+                    return
+                wait = (1 - self.tokens)*self.rate_limit
+            time.sleep(wait)
+
+
+class Downloader:
+    """
+    Download engine keeping up to `max_threads` requests in flight at the same time.
+    All the requests are gated by the RateLimiter `limiter`, or if not provided by a new one where `rate_limit`
+    is the minimum average time (in seconds) between two consecutive requests.
+    If a TileCache is provided, it is checked before sending a request to SentinelHub
+    and the downloaded tiles are stored in it.
+    """
+    def __init__(self, rate_limit=1, max_threads=4, cache=None, config=None, limiter=None):
+        self.max_threads = max_threads
+        self.cache = cache
+        self.config = config
+        self.limiter = limiter or RateLimiter(rate_limit)
+
+    """
+    Send a single SentinelHubRequest and return the path of the tiff saved on disk.
+    """
+    def _fetch(self, sh_request):
+        self.limiter.acquire()
+        dl_request = sh_request.download_list[0]
+        _ = SentinelHubDownloadClient(config=self.config).download([dl_request], max_threads=1, decode_data=False)
+        return(str(Path(sh_request.data_folder) / sh_request.get_filename_list()[0]))
+
+    """
+    Download a single SentinelHubRequest and pass it to `on_tile`.
+    """
+    def _download(self, sh_request, max_retry, manifest, on_tile=None):
+        tiff = self._get(sh_request, max_retry, manifest)
+        if(on_tile is not None):
+            on_tile(tiff)
+        return(tiff)
+
+    """
+    Get the tiff of a single SentinelHubRequest, retrying only this tile in case of failure.
+    Tiles already completed according to the manifest, or stored in the cache, are not requested again.
+    """
+    def _get(self, sh_request, max_retry, manifest):
+        key = tile_key(sh_request)
+
+        if(manifest is not None):
+            tiff = manifest.get('tiles', key)
+            if(tiff is not None and os.path.exists(tiff) and not (self.cache is not None and self.cache.owns(tiff))):
+                return(tiff)
+
+        if(self.cache is not None):
+            tiff = self.cache.get(key)
+            if(tiff is not None):
+                return(tiff)
+
+        tiff = backoff_retry(max_retry, self._fetch, sh_request=sh_request)
+
+        if(self.cache is not None):
+            tiff = self.cache.put(key, tiff)
+        if(manifest is not None):
+            manifest.set('tiles', key, tiff)
+        return(tiff)
+
+    """
+    Download a list of SentinelHubRequest, the paths of the tiffs are returned in the same order of the requests.
+    Every tile is retried up to `max_retry` times with exponential backoff.
+    If provided, `on_tile` is called with the path of each tile as soon as it is available, from the download thread.
+    """
+    def download(self, sh_requests, max_retry=10, manifest=None, on_tile=None):
+        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            futures = [executor.submit(self._download, sh_request, max_retry, manifest, on_tile) for sh_request in sh_requests]
+            tiffs = [future.result() for future in futures]
+        return(tiffs)
+
+    """
+    Download a list of SentinelHubRequest writing every tile in a raster.TileWriter as soon as it is available.
+    Tiles are released once written, or at the end of the download when a manifest is used,
+    so that an interrupted download can be resumed from the tiles already on disk.
+    """
+    def download_into(self, sh_requests, writer, max_retry=10, manifest=None):
+        def on_tile(tiff):
+            writer.write(tiff)
+            if(manifest is None):
+                self.release([tiff])
+
+        tiffs = self.download(sh_requests, max_retry=max_retry, manifest=manifest, on_tile=on_tile)
+        if(manifest is not None):
+            self.release(tiffs)
+
+    """
+    Release the tiffs returned by `download` once they have been consumed:
+    cached tiffs become evictable, the others are deleted.
+    """
+    def release(self, tiffs):
+        for tiff in tiffs:
+            if(self.cache is not None and self.cache.owns(tiff)):
+                self.cache.unpin(tiff)
+            elif(os.path.exists(tiff)):
+                os.remove(tiff)
+
+
+_DOWNLOADERS = {}
+_LIMITERS = {}
+_DOWNLOADERS_LOCK = threading.Lock()
+
+"""
+Return the RateLimiter shared by all the Downloaders of the given rate limit and account (the client id of `config`,
+the default configuration if not provided), such that together they do not exceed the quota of the account.
+"""
+def get_limiter(rate_limit=1, config=None):
+    key = (rate_limit, (config or SHConfig()).sh_client_id)
+    with _DOWNLOADERS_LOCK:
+        if(key not in _LIMITERS):
+            _LIMITERS[key] = RateLimiter(rate_limit)
+        return(_LIMITERS[key])
+
+
+"""
+Return the Downloader shared by all the modules for the given rate limit, number of threads and cache,
+so that consecutive downloads (e.g. different time slots) reuse the same threads and cache.
+Downloaders with different numbers of threads or caches are gated by the same token bucket (see get_limiter).
+The cache is disabled when `cache_dir` is None.
+"""
+def get_downloader(rate_limit=1, max_threads=4, cache_dir=None, cache_size=CACHE_SIZE):
+    cache = None
+    if(cache_dir is not None):
+        cache = get_cache(cache_dir, max_bytes=cache_size)
+
+    limiter = get_limiter(rate_limit)
+    key = (rate_limit, max_threads, None if cache is None else cache.folder)
+    with _DOWNLOADERS_LOCK:
+        if(key not in _DOWNLOADERS):
+            _DOWNLOADERS[key] = Downloader(max_threads=max_threads, cache=cache, limiter=limiter)
+        return(_DOWNLOADERS[key])
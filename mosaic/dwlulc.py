@@ -5,87 +5,162 @@ https://dynamicworld.app/
 
 import tensorflow as tf
 import numpy as np
-from mosaic.sentinel2 import download
-from mosaic.utils import shretry
+from mosaic.sentinel2 import download, RESOLUTION
+from mosaic import evalscripts
+from mosaic.manifest import RunManifest
+from mosaic.scratch import get_scratch
+from mosaic.raster import get_output_grid, get_output_profile, write_cog, BLOCK_SIZE, COMPRESS, PREDICTOR
+from mosaic.compositor import Compositor
+from mosaic.cube import DataCube
+from mosaic.cache import CACHE_SIZE
+from mosaic import catalog
+from mosaic.catalog import CATALOG_TTL
+from sentinelhub import BBox, DataCollection, CRS
 from mosaic.clouddetection import Inference as CloudDetection
-from dynamicworld.inference import Inference as LULCDetection
+from mosaic.lulcdetection import Inference as LULCDetection
+from mosaic.reclassify import Reclassification
 import os
 import shutil
 import rasterio
 
-from mosaic.utils import split_interval
+from mosaic.utils import split_interval, resolve_split_shape, prefetch
 
 NO_DATA = 240
+BANDS = evalscripts.SENTINEL2_BANDS  # the Dynamic World model uses all the Sentinel-2 bands
 
+# index of the most probable Dynamic World class (water, trees, grass, flooded vegetation, crops,
+# shrub and scrub, built, bare, snow and ice) to output class
+CLASSES = {index: index for index in range(9)}
+RECLASSIFICATION = Reclassification(CLASSES, nodata=NO_DATA, dtype=np.int16, default=NO_DATA)
 
 
-def mosaic(bbox, start, end, output, n, max_retry = 10, split_shape=(10, 10)):
+
+def mosaic(bbox, start, end, output, n, max_retry = 10, split_shape=(10, 10), rate_limit=1, max_threads=4, cache_dir=None, cache_size=CACHE_SIZE, resume=False, tile_size=None, cloud_chunk_size=None, cloud_overlap=16, cloud_workers=1, cloud_resolution=None, cloud_mask="s2cloudless", queue_depth=1, lulc_tile_size=None, lulc_overlap=32, lulc_batch_size=4, prune_tiles=False, catalog_ttl=CATALOG_TTL, scratch_dir=None, disk_budget=None, cog=False, cog_blocksize=BLOCK_SIZE, cog_compress=COMPRESS, cog_predictor=PREDICTOR, cube=None, cube_chunk_size=BLOCK_SIZE):
     slots = split_interval(start, end, n)
+    split_shape = resolve_split_shape(bbox, split_shape, RESOLUTION, tile_size)
     
-    landcover = LULCDetection()
-    clouddetection = CloudDetection(all_bands=True)
-
-
-    merged_mask = None
-    merged_bands = None
-
-    files = []
-    for slot in slots:
-        print(slot)
-        image = './image_{start}_{end}.tiff'.format(start = slot[0], end = slot[1])
-        shretry(max_retry, download, bbox = bbox, time_interval = slot, output = image, split_shape=split_shape)
-        with rasterio.open(image, 'r') as file:
-            bands = file.read()
-            mask  = bands[-1,  :, :]
-            bands = bands[:-1, :, :]
-
-            bands = bands.transpose((1,2,0))
-            s2_mask = bands==file.nodata
-
-            bands[s2_mask] = 0
-
-            # plt.imshow(bands[:, :, [3,2,1]].clip(0,3000)/3000)
-            # plt.show()
-
-            cloud_prob = clouddetection.predict(bands.astype(np.float32)[np.newaxis, ...]/10000.0)[0, :, :]
-            bands = landcover.predict(bands)
-
-            mask = mask>0
-            mask[cloud_prob > 0.4] = 0
-            mask[s2_mask.prod(-1)] = 0
-            bands[mask==0] = 1.0/bands.shape[-1]
-
-            profile = file.profile
-
-        bands = bands.transpose((2,0,1)) #metto la predizione sulla coordinata 0
-
-
-
-        if(merged_mask is None):
-            merged_mask = mask
-            merged_bands = bands
-        else:
-            merged_mask = merged_mask + mask
-            merged_bands = merged_bands + bands
+    landcover = LULCDetection(tile_size=lulc_tile_size, overlap=lulc_overlap, batch_size=lulc_batch_size)
+    # the clouds are detected locally by s2cloudless, or masked by Sentinel Hub with its CLP or CLM bands
+    if(cloud_mask != "s2cloudless" and cloud_mask not in evalscripts.CLOUD_MASKS):
+        raise Exception(f'Unknown cloud mask {cloud_mask}')
+    local_mask = cloud_mask == "s2cloudless"
+    if(local_mask):
+        clouddetection = CloudDetection(all_bands=True, chunk_size=cloud_chunk_size, overlap=cloud_overlap, workers=cloud_workers, resolution=cloud_resolution, image_resolution=RESOLUTION)
+
+    manifest = None
+    if(resume):
+        manifest = RunManifest(output + '.manifest.json', {'bbox': list(bbox), 'start': start, 'end': end, 'n': n, 'split_shape': split_shape, 'cloud_mask': cloud_mask})
+
+
+    # the intermediates are written in the scratch space of the run, within the disk budget
+    with get_scratch(output, scratch_dir, disk_budget, resume) as scratch:
+        compositor = Compositor()
+
+        transform, width, height = get_output_grid(bbox, RESOLUTION)
+
+        # with `cube`, the class probabilities of every slot are also stored in the [time, class, y, x] data cube
+        # in the folder `cube`, NaN where the pixels are not valid
+        datacube = None
+        if(cube is not None):
+            attrs = {'transform': list(transform)[:6], 'crs': 'EPSG:4326', 'classes': len(CLASSES)}
+            datacube = DataCube(cube, slots, (len(CLASSES), height, width), np.float32, np.nan, chunk_size=cube_chunk_size, attrs=attrs)
+
+        def get_path(slot):
+            return(scratch.path('image_{start}_{end}.tiff'.format(start = slot[0], end = slot[1])))
+
+        # the land cover of a slot is kept until the end of the run, to resume it without downloading
+        # and predicting the slot again
+        def get_prediction_path(slot):
+            return(scratch.path('lulc_{start}_{end}.npz'.format(start = slot[0], end = slot[1])))
+
+        # a slot is downloaded only when its image fits in the disk budget
+        def reserve(slot, force):
+            return(scratch.reserve(get_path(slot), width*height*len(BANDS)*np.dtype(np.int16).itemsize, force))
+
+        def fetch(slot):
+            image = get_path(slot)
+            slot_key = '{start}_{end}'.format(start = slot[0], end = slot[1])
+            if(manifest is not None and manifest.get('slots', slot_key) is not None and os.path.exists(get_prediction_path(slot))):
+                return(None, slot_key)  # completed by the interrupted run
+
+            # with `prune_tiles`, the tiles without any acquisition in the catalog are not requested
+            coverage = None
+            if(prune_tiles):
+                folder = None if cache_dir is None else os.path.join(cache_dir, 'catalog')
+                coverage = catalog.get_coverage(DataCollection.SENTINEL2_L1C, BBox(bbox, crs=CRS.WGS84), slot, folder=folder, ttl=catalog_ttl)
+            download(bbox = bbox, time_interval = slot, output = image, split_shape=split_shape, rate_limit=rate_limit, max_threads=max_threads, cache_dir=cache_dir, cache_size=cache_size, max_retry=max_retry, manifest=manifest, bands=BANDS, cloud_mask=None if local_mask else cloud_mask, coverage=coverage, data_folder=scratch.path('tiles'))
+            return(image, slot_key)
+
+        # the next `queue_depth` slots are downloaded while the current one is processed
+        for slot, (image, slot_key) in prefetch(fetch, slots, depth=queue_depth, reserve=reserve):
+            print(slot)
+            if(image is None):
+                scratch.release(get_path(slot))
+                with np.load(get_prediction_path(slot)) as prediction:
+                    mask = prediction['mask']
+                    bands = prediction['bands'] if 'bands' in prediction else None
+                if(bands is not None):
+                    compositor.add(bands, mask)
+                    if(datacube is not None):
+                        datacube.write(slots.index(slot), np.where(mask[np.newaxis, ...], bands, np.nan))
+                continue
+
+            with rasterio.open(image, 'r') as file:
+                bands = file.read()
+
+                bands = bands.transpose((1,2,0))
+                s2_mask = bands==file.nodata
+                mask = ~s2_mask.all(-1)  # the dataMask is already applied as nodata
+
+                bands[s2_mask] = 0
+
+                # plt.imshow(bands[:, :, [3,2,1]].clip(0,3000)/3000)
+                # plt.show()
+
+                if(local_mask and mask.any()):
+                    cloud_prob = clouddetection.predict(bands.astype(np.float32)[np.newaxis, ...]/10000.0)[0, :, :]
+                    mask[cloud_prob > 0.4] = 0
+                # the land cover is predicted only where there are valid pixels
+                bands = landcover.predict(bands, mask)
+
+            if(bands is not None):
+                bands = bands.transpose((2,0,1)) #metto la predizione sulla coordinata 0
+                compositor.add(bands, mask)
+                if(datacube is not None):
+                    datacube.write(slots.index(slot), np.where(mask[np.newaxis, ...], bands, np.nan))
+            else:
+                print('No valid pixels, the land cover is not predicted')
+
+            if(manifest is not None):
+                prediction = get_prediction_path(slot)
+                if(bands is not None):
+                    np.savez(prediction, mask=mask, bands=bands)
+                else:
+                    np.savez(prediction, mask=mask)
+                manifest.set('slots', slot_key, prediction)
+            del bands
         
-        files.append(image)
-        if(len(files)<len(slots)):
-            os.remove(image)
-
-    
-    merged_mask[merged_mask==0] = np.nan
-    merged_bands = merged_bands/merged_mask
-
-    merged_bands = merged_bands.argmax(0)
+            scratch.release(image)
 
-    merged_bands[np.isnan(merged_bands)] = NO_DATA
-    merged_bands = np.expand_dims(merged_bands, 0)
-    merged_bands = merged_bands.astype(np.int16)
-    
+        if(local_mask):
+            clouddetection.close()  # the workers of the cloud detection are kept between the slots
+        if(datacube is not None):
+            datacube.close()
     
-    shutil.copyfile(files[-1], output)
-
-    profile.update(count = 1, dtype = np.int16)
-    with rasterio.open(output, 'w', **profile) as file:
-        file.write(merged_bands)
-    os.remove(files[-1])
\ No newline at end of file
+        if(compositor.sum is not None):
+            merged_bands = compositor.mean(nodata=0, dtype=np.float32).argmax(0).astype(np.uint8)
+            merged_bands = RECLASSIFICATION.apply(merged_bands, mask=compositor.count>0)
+        else:
+            merged_bands = np.full((height, width), NO_DATA, dtype=np.int16)
+        merged_bands = np.expand_dims(merged_bands, 0)
+
+        # with `cog`, the land cover is written in the scratch space and copied to a Cloud-Optimized GeoTIFF
+        composite = scratch.path('composite.tiff') if cog else output
+        profile = get_output_profile(bbox, RESOLUTION, count = 1, dtype = np.int16, nodata = NO_DATA)
+        with rasterio.open(composite, 'w', **profile) as file:
+            file.write(merged_bands)
+        if(cog):
+            write_cog(composite, output, blocksize=cog_blocksize, compress=cog_compress, predictor=cog_predictor, resampling='nearest')
+
+        if(manifest is not None):
+            manifest.remove()
\ No newline at end of file
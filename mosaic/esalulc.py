@@ -10,25 +10,42 @@ from mosaic import evalscripts
 import rasterio
 import numpy as np
 import datetime
-from mosaic.utils import shretry, gdal_merge
+from mosaic.downloader import get_downloader
+from mosaic.cache import CACHE_SIZE
+from mosaic import catalog
+from mosaic.catalog import CATALOG_TTL
+from mosaic.manifest import RunManifest
+from mosaic.scratch import get_scratch
+from mosaic.raster import TileWriter, get_windows, write_cog, BLOCK_SIZE, COMPRESS, PREDICTOR
+from mosaic.reclassify import Reclassification
+from mosaic.utils import resolve_split_shape
 import os
-import time
 
 NO_DATA = 240
 RESOLUTION = 10
+BYTES_PER_BAND = 2  # peak memory per pixel and band used while processing a window
 CRS = sentinelhub.CRS.WGS84
+COLLECTION = DataCollection.define_byoc(collection_id="0b940c63-45dd-4e6b-8019-c3660b81b884")
 
+# WorldCover classes remapped to consecutive indices, 0 is nodata in the WorldCover map
+CLASSES = {10: 0, 20: 1, 30: 2, 40: 3, 50: 4, 60: 5, 70: 6, 80: 7, 90: 8, 95: 9, 100: 10}
+RECLASSIFICATION = Reclassification(CLASSES, nodata=NO_DATA, dtype=np.uint8, src_nodata=0)
 
-def download(bbox, time_interval, output, split_shape = (10, 10), rate_limit=1):
+
+"""
+Download the map writing the tiles directly in the output as they arrive.
+The tiles not intersecting the `coverage` geometry are not requested.
+"""
+def download(bbox, time_interval, output, split_shape = (10, 10), rate_limit=1, max_threads=4, cache_dir=None, cache_size=CACHE_SIZE, max_retry=10, manifest=None, tile_size=None, coverage=None, data_folder="test_dir"):
 
     def get_image(bbox, resolution):
         size = bbox_to_dimensions(bbox, resolution=resolution)
         request = SentinelHubRequest(
-            data_folder="test_dir",
+            data_folder=data_folder,
             evalscript=evalscripts.WORLDCOVER,
             input_data=[
                 SentinelHubRequest.input_data(
-                    data_collection=DataCollection.define_byoc(collection_id="0b940c63-45dd-4e6b-8019-c3660b81b884"),
+                    data_collection=COLLECTION,
                     time_interval=time_interval,
                     mosaicking_order=MosaickingOrder.MOST_RECENT
                 )
@@ -41,58 +58,50 @@ def download(bbox, time_interval, output, split_shape = (10, 10), rate_limit=1):
         return(request)
 
 
+    split_shape = resolve_split_shape(bbox, split_shape, RESOLUTION, tile_size)
     bbox_splitter = BBoxSplitter(
         [ BBox(bbox, crs=CRS) ], crs = CRS, split_shape = split_shape
     )  # bounding box will be split into grid of 5x4 bounding boxes
 
     bbox_list = bbox_splitter.get_bbox_list()
+    if(coverage is not None):
+        bbox_list = catalog.prune_tiles(bbox_list, coverage)
     sh_requests = [get_image(bbox, RESOLUTION) for bbox in bbox_list]
     
-    #dl_requests = [request.download_list[0] for request in sh_requests]
-    #_ = SentinelHubDownloadClient(config=None).download(dl_requests, max_threads=5)
-
-    for request in sh_requests:
-        dl_request = request.download_list[0]
-        _ = SentinelHubDownloadClient(config=None).download([dl_request], max_threads=1)
-        time.sleep(rate_limit)  # Pause for the specified time delay
-
-    data_folder = sh_requests[0].data_folder
-    tiffs = [Path(data_folder) / req.get_filename_list()[0] for req in sh_requests]
-    str_tiffs = [str(tiff) for tiff in tiffs]
-    gdal_merge(str_tiffs, bbox, output=output, dstnodata=NO_DATA)
-    
-    for str_tiff in str_tiffs:
-        os.remove(str_tiff)
+    downloader = get_downloader(rate_limit, max_threads, cache_dir, cache_size)
+    with TileWriter(output, bbox, RESOLUTION, nodata=NO_DATA, dtype=np.uint8, count=1) as writer:
+        downloader.download_into(sh_requests, writer, max_retry=max_retry, manifest=manifest)
     
-def mosaic(bbox, start, end, output, max_retry=10, split_shape=(10, 10), rate_limit=1):
-
-    shretry(max_retry, download, bbox = bbox, time_interval=(start, end), output = output, split_shape = split_shape, rate_limit=1)
-
-    with rasterio.open(output, 'r') as file:
-        bands = file.read()
-        mask  = bands[-1,  :, :]
-        bands = bands[:-1, :, :]
-        profile = file.profile
-
-
-    profile.update(count = bands.shape[0])
-    with rasterio.open(output, 'w', **profile) as file:
-        bands = np.array(bands).transpose((1,2,0))
-
-        bands[bands == 0] = NO_DATA
-        bands[bands == 10] = 0
-        bands[bands == 20] = 1
-        bands[bands == 30] = 2
-        bands[bands == 40] = 3
-        bands[bands == 50] = 4
-        bands[bands == 60] = 5
-        bands[bands == 70] = 6
-        bands[bands == 80] = 7
-        bands[bands == 90] = 8
-        bands[bands == 95] = 9
-        bands[bands == 100] = 10
-        bands[mask==0] = NO_DATA
-        bands = np.array(bands).transpose((2,0,1))
-
-        file.nodata = NO_DATA
-        file.write(bands)
\ No newline at end of file
+def mosaic(bbox, start, end, output, max_retry=10, split_shape=(10, 10), rate_limit=1, max_threads=4, cache_dir=None, cache_size=CACHE_SIZE, resume=False, tile_size=None, memory_budget=None, prune_tiles=False, catalog_ttl=CATALOG_TTL, scratch_dir=None, cog=False, cog_blocksize=BLOCK_SIZE, cog_compress=COMPRESS, cog_predictor=PREDICTOR):
+
+    split_shape = resolve_split_shape(bbox, split_shape, RESOLUTION, tile_size)
+
+    manifest = None
+    if(resume):
+        manifest = RunManifest(output + '.manifest.json', {'bbox': list(bbox), 'start': start, 'end': end, 'split_shape': split_shape, 'prune_tiles': prune_tiles})
+
+    # with `prune_tiles`, the tiles outside of the map (e.g. on the sea) are not requested
+    coverage = None
+    if(prune_tiles):
+        folder = None if cache_dir is None else os.path.join(cache_dir, 'catalog')
+        coverage = catalog.get_coverage(COLLECTION, BBox(bbox, crs=CRS), (start, end), folder=folder, ttl=catalog_ttl)
+
+    # the tiles are downloaded in the scratch space of the run
+    # with `cog`, the map is written in the scratch space and copied to a Cloud-Optimized GeoTIFF
+    with get_scratch(output, scratch_dir, resume=resume) as scratch:
+        classes = scratch.path('classes.tiff') if cog else output
+        download(bbox = bbox, time_interval=(start, end), output = classes, split_shape = split_shape, rate_limit=rate_limit, max_threads=max_threads, cache_dir=cache_dir, cache_size=cache_size, max_retry=max_retry, manifest=manifest, coverage=coverage, data_folder=scratch.path('tiles'))
+
+        with rasterio.open(classes, 'r+') as file:
+            for window in get_windows(file, BYTES_PER_BAND*file.count, memory_budget):
+                bands = file.read(window=window)
+
+                bands = RECLASSIFICATION.apply(bands)
+
+                file.write(bands, window=window)
+
+        if(cog):
+            write_cog(classes, output, blocksize=cog_blocksize, compress=cog_compress, predictor=cog_predictor, resampling='nearest')
+
+    if(manifest is not None):
+        manifest.remove()
\ No newline at end of file
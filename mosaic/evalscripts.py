@@ -33,38 +33,72 @@ SENTINEL1 = """
 """
 Sentinel-2
 """
-SENTINEL2 = """
+SENTINEL2_BANDS = ["B01","B02","B03","B04","B05","B06","B07","B08","B8A","B09","B10","B11","B12"]
+
+"""
+Bands used by s2cloudless, in the order expected by the model.
+"""
+CLOUD_BANDS = ["B01","B02","B04","B05","B08","B8A","B09","B10","B11","B12"]
+
+"""
+Cloud masks precomputed by Sentinel Hub: the cloud probability (CLP, from 0 to 255) and the cloud mask (CLM, 1 for clouds).
+"""
+CLOUD_MASKS = ["CLP", "CLM"]
+CLOUD_THRESHOLD = 0.4
+
+"""
+Unique bands in the order of SENTINEL2_BANDS.
+"""
+def sort_bands(bands):
+    return([band for band in SENTINEL2_BANDS if band in bands])
+
+"""
+Evalscript of the Sentinel-2 L1C returning the given bands (in the order of SENTINEL2_BANDS) followed by the dataMask.
+If `cloud_mask` is one of CLOUD_MASKS, the cloudy pixels are removed from the dataMask by Sentinel Hub,
+with the cloud probability compared with `cloud_threshold` for CLP.
+"""
+def sentinel2(bands = SENTINEL2_BANDS, cloud_mask = None, cloud_threshold = CLOUD_THRESHOLD):
+    unknown = [band for band in bands if band not in SENTINEL2_BANDS]
+    if(len(unknown) > 0):
+        raise Exception(f'Unknown Sentinel-2 bands: {unknown}')
+    if(cloud_mask is not None and cloud_mask not in CLOUD_MASKS):
+        raise Exception(f'Unknown cloud mask {cloud_mask}, expected one of {CLOUD_MASKS}')
+    bands = sort_bands(bands)
+
+    inputs = bands + ["dataMask"]
+    mask = "sample.dataMask"
+    if(cloud_mask == "CLP"):
+        inputs = inputs + ["CLP"]
+        mask = "sample.dataMask * (sample.CLP <= {threshold} ? 1 : 0)".format(threshold = int(cloud_threshold*255))
+    elif(cloud_mask == "CLM"):
+        inputs = inputs + ["CLM"]
+        mask = "sample.dataMask * (sample.CLM == 0 ? 1 : 0)"
+
+    return("""
     //VERSION=3
-    function setup() {
-        return {
-            input: [{
-                bands: ["B01","B02","B03","B04","B05","B06","B07","B08","B8A","B09","B10","B11","B12","dataMask"],
+    function setup() {{
+        return {{
+            input: [{{
+                bands: [{input}],
                 units: "DN"
-            }],
-            output: {
-                bands: 14,
+            }}],
+            output: {{
+                bands: {count},
                 sampleType: "INT16"
-            }
-        };
-    }
+            }}
+        }};
+    }}
 
-    function evaluatePixel(sample) {
-        return [sample.B01,
-                sample.B02,
-                sample.B03,
-                sample.B04,
-                sample.B05,
-                sample.B06,
-                sample.B07,
-                sample.B08,
-                sample.B8A,
-                sample.B09,
-                sample.B10,
-                sample.B11,
-                sample.B12,
-                sample.dataMask];
-    }
-"""
+    function evaluatePixel(sample) {{
+        return [{output}];
+    }}
+""".format(
+        input = ",".join('"{band}"'.format(band=band) for band in inputs),
+        count = len(bands) + 1,
+        output = ",\n                ".join(["sample.{band}".format(band=band) for band in bands] + [mask]),
+    ))
+
+SENTINEL2 = sentinel2(SENTINEL2_BANDS)
 
 """
 Copernicus DEM
@@ -0,0 +1,65 @@
+"""
+Land cover detection wrapper
+"""
+
+import functools
+import numpy as np
+
+
+"""
+Dynamic World model, loaded once per process and shared by all the Inference objects.
+"""
+@functools.lru_cache(maxsize=None)
+def _get_model():
+    from dynamicworld.inference import Inference as LULCDetection
+    return(LULCDetection())
+
+
+class Inference:
+    """
+    Extraction of the land cover probabilities from a Sentinel-2 image in input.
+    The wrapper is using Dynamic World: https://github.com/DeepCube-org/dynamicworld
+    If `tile_size` is provided, the image is split in tiles of `tile_size` x `tile_size` pixels,
+    extended by `overlap` pixels on each side (mirroring the image at its borders).
+    The tiles are predicted `batch_size` at a time: the tiles of a batch are placed side by side in a single image,
+    each one with its overlap, so that the model runs once per batch. Only the core of each tile is kept,
+    so the overlap should cover the receptive field of the model.
+    """
+    def __init__(self, tile_size=None, overlap=0, batch_size=1):
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.model = _get_model()
+
+    """
+    image is expected to be of shape [H, W, 13] with all the Sentinel-2 Bands,
+    the result is of shape [H, W, C] with the probabilities of the C land cover classes.
+    If `mask` ([H, W], True for the pixels to use) is provided, the tiles without any pixel to use are not predicted
+    and their probabilities are 0. None is returned if there is no pixel to use.
+    """
+    def predict(self, image, mask=None):
+        if(mask is not None and not mask.any()):
+            return(None)
+        if(self.tile_size is None):
+            return(self.model.predict(image))
+
+        height, width = image.shape[:2]
+        size, overlap = self.tile_size, self.overlap
+        padded = np.pad(image, ((overlap, overlap + (-height)%size), (overlap, overlap + (-width)%size), (0, 0)), mode='symmetric')
+
+        tiles = [(row, col) for row in range(0, height, size) for col in range(0, width, size)]
+        if(mask is not None):
+            tiles = [(row, col) for row, col in tiles if mask[row:row + size, col:col + size].any()]
+        probs = None
+        for start in range(0, len(tiles), self.batch_size):
+            batch = tiles[start:start + self.batch_size]
+            batch_image = np.concatenate([padded[row:row + size + 2*overlap, col:col + size + 2*overlap] for row, col in batch], axis=1)
+            batch_probs = self.model.predict(batch_image)
+
+            if(probs is None):
+                probs = np.zeros((height, width, batch_probs.shape[-1]), dtype=batch_probs.dtype)
+            for i, (row, col) in enumerate(batch):
+                offset = i*(size + 2*overlap) + overlap
+                tile_probs = batch_probs[overlap:overlap + size, offset:offset + size]
+                probs[row:row + size, col:col + size] = tile_probs[:height - row, :width - col]
+        return(probs)
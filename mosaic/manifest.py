@@ -0,0 +1,56 @@
+"""
+Manifest of a mosaic run, used to resume an interrupted run where it stopped.
+"""
+
+import json
+import os
+import threading
+
+
+class RunManifest:
+    """
+    JSON file recording the completed tiles, time slots and Sentinel-1 groups of a run.
+    The manifest is bound to the parameters of the run: if the file on disk was created
+    by a run with different parameters, it is discarded.
+    """
+    def __init__(self, path, run):
+        self.path = path
+        self.lock = threading.Lock()
+        run = json.loads(json.dumps(run, default=str))
+
+        self.content = None
+        if(os.path.exists(path)):
+            with open(path, 'r') as f:
+                content = json.load(f)
+            if(content.get('run') == run):
+                self.content = content
+                print(f"resuming run from {path}")
+
+        if(self.content is None):
+            self.content = {'run': run, 'tiles': {}, 'slots': {}, 'groups': {}}
+
+    """
+    Value recorded for a key of a section ('tiles', 'slots' or 'groups'), None if the key is not completed.
+    """
+    def get(self, section, key):
+        with self.lock:
+            return(self.content[section].get(key))
+
+    """
+    Record a completed key of a section and save the manifest on disk.
+    """
+    def set(self, section, key, value):
+        with self.lock:
+            self.content[section][key] = value
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.content, f)
+            os.replace(tmp, self.path)
+
+    """
+    Delete the manifest, to be called when the run is completed.
+    """
+    def remove(self):
+        with self.lock:
+            if(os.path.exists(self.path)):
+                os.remove(self.path)
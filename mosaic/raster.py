@@ -0,0 +1,295 @@
+"""
+Raster operations executed in process with rasterio, without spawning GDAL command line tools.
+"""
+
+import threading
+import numpy as np
+import rasterio
+import rasterio.shutil
+import rasterio.windows
+from rasterio.crs import CRS
+from rasterio.transform import from_origin, from_bounds
+from sentinelhub import BBox, bbox_to_dimensions
+import sentinelhub
+from rasterio.warp import reproject, Resampling
+
+BLOCK_SIZE = 512
+COMPRESS = 'DEFLATE'
+PREDICTOR = 'YES'  # horizontal differencing for integer types, floating point predictor for floating point types
+DEFAULT_CRS = CRS.from_epsg(4326)
+PIXEL_EPSILON = 1e-6  # floating point error tolerated on pixel coordinates
+
+
+"""
+Grid covering the bounding box with pixels of (approximately) the given size.
+Returns the affine transform, the width and the height of the grid.
+"""
+def get_grid(bbox, res_x, res_y):
+    width  = max(1, int(round((bbox[2] - bbox[0])/res_x)))
+    height = max(1, int(round((bbox[3] - bbox[1])/res_y)))
+    transform = from_origin(bbox[0], bbox[3], (bbox[2] - bbox[0])/width, (bbox[3] - bbox[1])/height)
+    return(transform, width, height)
+
+
+"""
+Grid covering the bounding box (EPSG:4326) with pixels of the given resolution (in meters), as used by SentinelHub.
+Returns the affine transform, the width and the height of the grid.
+"""
+def get_output_grid(bbox, resolution):
+    width, height = bbox_to_dimensions(BBox(list(bbox), crs=sentinelhub.CRS.WGS84), resolution=resolution)
+    transform = from_bounds(*list(bbox), width, height)
+    return(transform, width, height)
+
+
+"""
+Profile of a tiled GeoTIFF on the grid covering the bounding box (EPSG:4326) with pixels of the given resolution (in meters).
+"""
+def get_output_profile(bbox, resolution, count, dtype, nodata, blocksize=BLOCK_SIZE):
+    transform, width, height = get_output_grid(bbox, resolution)
+    return({
+        'driver': 'GTiff',
+        'width': width,
+        'height': height,
+        'count': count,
+        'dtype': dtype,
+        'crs': DEFAULT_CRS,
+        'transform': transform,
+        'nodata': nodata,
+        'tiled': True,
+        'blockxsize': blocksize,
+        'blockysize': blocksize,
+    })
+
+
+"""
+Windows of size `blocksize` x `blocksize` covering a raster of the given size.
+"""
+def get_blocks(width, height, blocksize=BLOCK_SIZE):
+    for row in range(0, height, blocksize):
+        for col in range(0, width, blocksize):
+            yield rasterio.windows.Window(col, row, min(blocksize, width - col), min(blocksize, height - row))
+
+
+"""
+Windows covering a dataset, aligned to its internal tiling, such that a window of `bytes_per_pixel`
+bytes per pixel fits in `memory_budget` bytes. Windows are strips of full rows when possible,
+otherwise blocks of the internal tiling. If `memory_budget` is None, a single window covers the whole dataset.
+"""
+def get_windows(dataset, bytes_per_pixel, memory_budget=None):
+    width, height = dataset.width, dataset.height
+    if(memory_budget is None):
+        yield rasterio.windows.Window(0, 0, width, height)
+        return
+
+    block_height, block_width = dataset.block_shapes[0]
+    rows = (memory_budget//(width*bytes_per_pixel))//block_height*block_height
+    if(rows > 0):
+        for row in range(0, height, rows):
+            yield rasterio.windows.Window(0, row, width, min(rows, height - row))
+    else:
+        cols = max(block_width, (memory_budget//(block_height*bytes_per_pixel))//block_width*block_width)
+        for row in range(0, height, block_height):
+            for col in range(0, width, cols):
+                yield rasterio.windows.Window(col, row, min(cols, width - col), min(block_height, height - row))
+
+
+"""
+Window of the grid covering the given bounds, clipped to the grid.
+The window includes every pixel partially covered by the bounds (the offsets are rounded down and the ends up,
+round_offsets and round_lengths do not take the rounding direction into account in all rasterio versions),
+bounds on a pixel edge up to PIXEL_EPSILON do not add a pixel.
+"""
+def get_window(bounds, transform, width, height):
+    window = rasterio.windows.from_bounds(*bounds, transform=transform)
+    col_off = max(0, int(np.floor(window.col_off + PIXEL_EPSILON)))
+    row_off = max(0, int(np.floor(window.row_off + PIXEL_EPSILON)))
+    col_end = min(width, int(np.ceil(window.col_off + window.width - PIXEL_EPSILON)))
+    row_end = min(height, int(np.ceil(window.row_off + window.height - PIXEL_EPSILON)))
+    return(rasterio.windows.Window(col_off, row_off, max(0, col_end - col_off), max(0, row_end - row_off)))
+
+
+"""
+Reproject a source dataset on a window of the destination grid.
+Returns the reprojected bands and a boolean array of the same shape, True where the source provides valid data.
+The valid pixels are given by the masks of the source (its nodata) reprojected as the bands, so that they do not
+depend on the `fill` value of the destination.
+"""
+def warp_window(src, dst_transform, dst_crs, shape, fill=0):
+    count, height, width = shape
+
+    data = np.full(shape, fill, dtype=src.dtypes[0])
+    reproject(
+        source=rasterio.band(src, list(range(1, count+1))),
+        destination=data,
+        src_transform=src.transform,
+        src_crs=src.crs or DEFAULT_CRS,
+        src_nodata=src.nodata,
+        dst_transform=dst_transform,
+        dst_crs=dst_crs,
+        dst_nodata=fill,
+        resampling=Resampling.nearest,
+    )
+
+    masks = np.zeros(shape, dtype=np.uint8)
+    reproject(
+        source=src.read_masks(list(range(1, count+1))),
+        destination=masks,
+        src_transform=src.transform,
+        src_crs=src.crs or DEFAULT_CRS,
+        dst_transform=dst_transform,
+        dst_crs=dst_crs,
+        dst_nodata=0,
+        resampling=Resampling.nearest,
+    )
+    return(data, masks > 0)
+
+
+"""
+Merge multiple images on the grid defined by the bounding box (EPSG:4326), writing the output one block at a time.
+Where images overlap, the valid pixels of the images coming later in the list are kept.
+The resolution is the finest one of the images in input.
+"""
+def merge(tiffs, bbox, output, dstnodata=None, blocksize=BLOCK_SIZE):
+    if(len(tiffs) == 0):
+        raise Exception('No images to merge')
+
+    sources = [rasterio.open(tiff, 'r') for tiff in tiffs]
+    try:
+        first = sources[0]
+        for tiff, src in zip(tiffs, sources):
+            if(src.count != first.count or src.dtypes[0] != first.dtypes[0]):
+                raise Exception(f'{tiff} is not compatible with {tiffs[0]}: {src.count} bands of type {src.dtypes[0]}, expected {first.count} bands of type {first.dtypes[0]}')
+
+        res_x = min(src.res[0] for src in sources)
+        res_y = min(src.res[1] for src in sources)
+        transform, width, height = get_grid(bbox, res_x, res_y)
+
+        nodata = dstnodata if dstnodata is not None else first.nodata
+        fill = nodata if nodata is not None else 0
+
+        profile = {
+            'driver': 'GTiff',
+            'width': width,
+            'height': height,
+            'count': first.count,
+            'dtype': first.dtypes[0],
+            'crs': DEFAULT_CRS,
+            'transform': transform,
+            'nodata': nodata,
+            'tiled': True,
+            'blockxsize': blocksize,
+            'blockysize': blocksize,
+        }
+
+        with rasterio.open(output, 'w', **profile) as dst:
+            for window in get_blocks(width, height, blocksize):
+                left, bottom, right, top = rasterio.windows.bounds(window, transform)
+                window_transform = rasterio.windows.transform(window, transform)
+                block = np.full((first.count, window.height, window.width), fill, dtype=first.dtypes[0])
+
+                for src in sources:
+                    if(src.bounds.left >= right or src.bounds.right <= left or src.bounds.bottom >= top or src.bounds.top <= bottom):
+                        continue
+                    data, valid = warp_window(src, window_transform, DEFAULT_CRS, block.shape, fill)
+                    block[valid] = data[valid]
+
+                dst.write(block, window=window)
+    finally:
+        for src in sources:
+            src.close()
+
+    return(output)
+
+
+"""
+Copy a raster to a Cloud-Optimized GeoTIFF, internally tiled in blocks of `blocksize` x `blocksize` pixels,
+compressed with the `compress` codec and the `predictor`, and with the overviews computed with `resampling`
+(e.g. 'average' for continuous values, 'nearest' for classes) in the same pass.
+"""
+def write_cog(tiff, output, blocksize=BLOCK_SIZE, compress=COMPRESS, predictor=PREDICTOR, resampling='nearest'):
+    with rasterio.open(tiff, 'r') as src:
+        rasterio.shutil.copy(
+            src,
+            output,
+            driver='COG',
+            BLOCKSIZE=blocksize,
+            COMPRESS=compress,
+            PREDICTOR=predictor,
+            OVERVIEWS='AUTO',
+            RESAMPLING=resampling,
+            BIGTIFF='IF_SAFER',
+        )
+    return(output)
+
+
+class TileWriter:
+    """
+    Output raster on the grid defined by the bounding box (EPSG:4326) and the resolution (in meters).
+    Tiles are written in their window as soon as they are available, with the last band of the tiles
+    used as dataMask: masked pixels are not written, and the mask band is not part of the output.
+    The raster is created when the first tile arrives, with the number of bands and the type of the tiles
+    (unless `dtype` is provided). Pixels not covered by any tile are nodata.
+    If `count` (number of bands without the dataMask) and `dtype` are provided and no tile is written,
+    the raster is created on close filled with nodata.
+    Tiles can be written concurrently from multiple threads.
+    """
+    def __init__(self, output, bbox, resolution, nodata, dtype=None, blocksize=BLOCK_SIZE, count=None):
+        self.output = output
+        self.count = count
+        self.nodata = nodata
+        self.dtype = dtype
+        self.blocksize = blocksize
+        self.transform, self.width, self.height = get_output_grid(bbox, resolution)
+        self.dst = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _create(self, count, dtype):
+        profile = {
+            'driver': 'GTiff',
+            'width': self.width,
+            'height': self.height,
+            'count': count,
+            'dtype': dtype,
+            'crs': DEFAULT_CRS,
+            'transform': self.transform,
+            'nodata': self.nodata,
+            'tiled': True,
+            'blockxsize': self.blocksize,
+            'blockysize': self.blocksize,
+        }
+        self.dst = rasterio.open(self.output, 'w+', **profile)
+
+    """
+    Write the valid pixels of a tile in its window of the output.
+    """
+    def write(self, tiff):
+        with rasterio.open(tiff, 'r') as src:
+            window = get_window(src.bounds, self.transform, self.width, self.height)
+            window_transform = rasterio.windows.transform(window, self.transform)
+
+            data, valid = warp_window(src, window_transform, DEFAULT_CRS, (src.count, window.height, window.width))
+            valid = valid[:-1] & (data[-1] > 0)[np.newaxis, ...]
+            data = data[:-1]
+
+            with self.lock:
+                if(self.dst is None):
+                    self._create(src.count - 1, self.dtype or src.dtypes[0])
+                block = self.dst.read(window=window)
+                block[valid] = data[valid]
+                self.dst.write(block, window=window)
+
+    def close(self):
+        with self.lock:
+            if(self.dst is None and self.count is not None and self.dtype is not None):
+                self._create(self.count, self.dtype)
+                for window in get_blocks(self.width, self.height, self.blocksize):
+                    self.dst.write(np.full((self.count, window.height, window.width), self.nodata, dtype=self.dtype), window=window)
+            if(self.dst is not None):
+                self.dst.close()
+                self.dst = None
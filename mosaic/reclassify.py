@@ -0,0 +1,55 @@
+"""
+Reclassification of categorical rasters through a lookup table.
+"""
+
+import numpy as np
+
+
+class Reclassification:
+    """
+    Remapping of the classes of a categorical raster, given as a {class: new class} dictionary.
+    The classes not in the mapping are kept as they are, or set to `default` if it is provided.
+    The `src_nodata` value of the input (if any) and the pixels masked by the dataMask are set to `nodata`.
+    The input has to be an integer type of at most 16 bits, such that the whole mapping fits in a lookup table
+    indexed by the pixel values: a block is remapped with a single pass, independently of the number of classes.
+    """
+    def __init__(self, mapping, nodata, dtype=np.uint8, src_nodata=None, default=None):
+        self.mapping = mapping
+        self.nodata = nodata
+        self.dtype = dtype
+        self.src_nodata = src_nodata
+        self.default = default
+        self.luts = {}
+
+    """
+    Lookup table for the input type, indexed by the values of the input seen as unsigned integers.
+    """
+    def lut(self, dtype):
+        dtype = np.dtype(dtype)
+        if(dtype not in self.luts):
+            if(dtype.kind not in 'iu' or dtype.itemsize > 2):
+                raise Exception(f'Reclassification supports integer types of at most 16 bits, not {dtype}')
+            index = np.dtype('u{size}'.format(size = dtype.itemsize))
+            values = np.arange(np.iinfo(index).max + 1, dtype=index).view(dtype)
+
+            if(self.default is None):
+                lut = values.astype(self.dtype)
+            else:
+                lut = np.full(values.shape, self.default, dtype=self.dtype)
+            for source, target in self.mapping.items():
+                lut[np.array(source, dtype=dtype).view(index)] = target
+            if(self.src_nodata is not None):
+                lut[np.array(self.src_nodata, dtype=dtype).view(index)] = self.nodata
+            self.luts[dtype] = lut
+        return(self.luts[dtype])
+
+    """
+    Reclassify an array of shape [..., H, W]. If `mask` is provided, it is a [H, W] boolean array
+    which is True for the valid pixels, the others are set to nodata.
+    """
+    def apply(self, bands, mask=None):
+        lut = self.lut(bands.dtype)
+        result = lut[bands.view(np.dtype('u{size}'.format(size = bands.dtype.itemsize)))]
+        if(mask is not None):
+            np.copyto(result, self.nodata, where=~mask)
+        return(result)
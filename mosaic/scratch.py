@@ -0,0 +1,80 @@
+"""
+Scratch space of a mosaic run, where the intermediate images and the downloaded tiles are written.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+
+
+class Scratch:
+    """
+    Folder holding the intermediates of a run, removed when the run ends.
+    By default it is a new temporary folder inside `folder` (the system temporary folder if not provided).
+    If `keep` is True, `folder` itself is used and it is left on disk when the run fails, so that it can be resumed.
+    With a `budget` (in bytes), a new intermediate is reserved only if the intermediates waiting to be consumed
+    leave enough space for it, so that the downloads wait for the processing of the previous images.
+    """
+    def __init__(self, folder=None, budget=None, keep=False):
+        self.keep = keep
+        self.budget = budget
+        if(keep):
+            os.makedirs(folder, exist_ok=True)
+            self.folder = folder
+        else:
+            if(folder is not None):
+                os.makedirs(folder, exist_ok=True)
+            self.folder = tempfile.mkdtemp(prefix='mosaic_', dir=folder)
+        self.used = 0
+        self.reserved = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, *args):
+        if(exc_type is None or not self.keep):
+            self.cleanup()
+
+    """
+    Path of an intermediate file or folder.
+    """
+    def path(self, name):
+        return(os.path.join(self.folder, name))
+
+    """
+    Reserve `nbytes` for the intermediate `path` if they fit in the budget, returning True if the space is reserved.
+    An intermediate is always reserved if nothing else is, or if `force` is True.
+    """
+    def reserve(self, path, nbytes, force=False):
+        with self.lock:
+            used = self.used - self.reserved.get(path, 0)
+            if(self.budget is not None and not force and used > 0 and used + nbytes > self.budget):
+                return(False)
+            self.used = used + nbytes
+            self.reserved[path] = nbytes
+            return(True)
+
+    """
+    Mark an intermediate as consumed, freeing its reservation, and delete it unless `remove` is False.
+    """
+    def release(self, path, remove=True):
+        with self.lock:
+            self.used = self.used - self.reserved.pop(path, 0)
+        if(remove and os.path.exists(path)):
+            os.remove(path)
+
+    def cleanup(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+"""
+Scratch space of the run producing `output`. When the run can be resumed, the scratch space is next to the output
+(or in `scratch_dir`) with a name derived from the output, so that a new run finds the intermediates of the previous one.
+"""
+def get_scratch(output, scratch_dir=None, disk_budget=None, resume=False):
+    if(resume):
+        folder = os.path.join(scratch_dir or os.path.dirname(os.path.abspath(output)), os.path.basename(output) + '.scratch')
+        return(Scratch(folder, budget=disk_budget, keep=True))
+    return(Scratch(scratch_dir, budget=disk_budget))
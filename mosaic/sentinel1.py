@@ -7,109 +7,80 @@ from sentinelhub.geometry import Geometry
 from sentinelhub.time_utils import parse_time
 from mosaic import evalscripts
 from pathlib import Path
-from sentinelhub import SentinelHubCatalog
 from sentinelhub import CRS, BBox, MimeType, SentinelHubRequest, DataCollection, bbox_to_dimensions, SentinelHubDownloadClient, MosaickingOrder
 import sentinelhub
 import datetime
 from sentinelhub import BBoxSplitter
 import os
 import shutil
+import json
 import numpy as np
 import sentinelhub
-from mosaic.utils import shretry, gdal_merge
+from mosaic.downloader import get_downloader
+from mosaic.cache import CACHE_SIZE
+from mosaic import catalog
+from mosaic.catalog import CATALOG_TTL
+from mosaic.manifest import RunManifest
+from mosaic.scratch import get_scratch
+from mosaic.raster import TileWriter, get_windows, get_blocks, get_output_grid, write_cog, BLOCK_SIZE, COMPRESS, PREDICTOR
+from mosaic.compositor import Compositor, get_state_path, read_state
+from mosaic.cube import DataCube, COMPOSITING
+from mosaic.utils import gdal_merge, resolve_split_shape, prefetch
 import shapely
 import rasterio
-import time
 
 NO_DATA = -9999
 RESOLUTION = 10
+BYTES_PER_BAND = 8  # peak memory per pixel and band used while processing a window
 CRS = sentinelhub.CRS.WGS84
 
 
-def get_orbits(bbox, time_interval):
+def get_orbits(bbox, time_interval, cache_dir=None, catalog_ttl=CATALOG_TTL):
 
-    catalog = SentinelHubCatalog()
-
-    search_iterator = catalog.search(
-        DataCollection.SENTINEL1_IW_DES,
-        bbox=bbox,
-        time=time_interval,
-    )
-
-    results = list(search_iterator)
+    folder = None if cache_dir is None else os.path.join(cache_dir, 'catalog')
+    results = catalog.search(DataCollection.SENTINEL1_IW_DES, bbox, time_interval, folder=folder, ttl=catalog_ttl)
     print("Total number of results:", len(results))
+    if(len(results) == 0):
+        return({}, {})
 
-    images = {}
-    dates  = {}
-    bboxes = {}
-
-    for result in results:
-
-        date = parse_time(result['properties']['datetime'])
-        id = result['id']
+    dates = np.array([parse_time(result['properties']['datetime']) for result in results], dtype=object)
+    times = np.array([date.timestamp() for date in dates])
+    platforms = np.array([result['properties']['platform'] for result in results])
+    absolute_orbits = np.array([result['properties']['sat:absolute_orbit'] for result in results])
 
-        if(result['properties']['platform'] == 'sentinel-1a'):
-            orbit =  (result['properties']['sat:absolute_orbit'] - 73)%175 + 1
-        elif(result['properties']['platform'] == 'sentinel-1b'):
-            orbit =  (result['properties']['sat:absolute_orbit'] - 27)%175 + 1
-        else:
-            raise Exception('Error, unreconized platform')
-        
-
-        #refbbox = bbox.transform_bounds(result['geometry']['crs']['properties']['name'])
-        sbbox = Geometry(result['geometry'], crs = result['geometry']['crs']['properties']['name'])
-        sbbox = sbbox.transform(CRS)        
+    orbits = np.full(len(results), -1)
+    orbits[platforms == 'sentinel-1a'] = (absolute_orbits[platforms == 'sentinel-1a'] - 73)%175 + 1
+    orbits[platforms == 'sentinel-1b'] = (absolute_orbits[platforms == 'sentinel-1b'] - 27)%175 + 1
+    if((orbits == -1).any()):
+        raise Exception('Error, unreconized platform')
 
-        #intersect = sbbox.geometry.intersection(refbbox.geometry).area
-        #intersect = intersect/refbbox.geometry.area
-        
-        if(orbit not in dates.keys()):
-            images[orbit] = []
-            dates[orbit]  = []
-            bboxes[orbit] = []
-        
-        images[orbit] += [id]
-        dates[orbit] += [date]
-        bboxes[orbit] += [sbbox]
-    
+    footprints = catalog.get_footprints(results)
 
-    for orbit in dates.keys():
-        idxs = [i[0] for i in sorted(enumerate(dates[orbit]), key=lambda x:x[1])]
-        dates[orbit]  = [dates[orbit][idx] for idx in idxs]
-        bboxes[orbit] = [bboxes[orbit][idx] for idx in idxs]
-        images[orbit] = [images[orbit][idx] for idx in idxs]
+    # sorted by orbit and then by date
+    idxs = np.lexsort((times, orbits))
+    orbit_dates = {}
+    orbit_footprints = {}
+    for orbit in np.unique(orbits):
+        selected = idxs[orbits[idxs] == orbit]
+        orbit_dates[int(orbit)] = list(dates[selected])
+        orbit_footprints[int(orbit)] = footprints[selected]
 
-    return(dates, bboxes)
+    return(orbit_dates, orbit_footprints)
 
+"""
+Index of the group of each date, the sorted dates closer than `timedelta` belong to the same group.
+"""
 def group_dates(dates, timedelta = datetime.timedelta(hours=1)):
-   
-    #idxs = [i[0] for i in sorted(enumerate(dates), key=lambda x:x[1])]
-    #dates = [dates[idx] for idx in idxs]
-    groups_idxs = []
-
-    prior_date = None
-    current_group = None
-    for i, date in enumerate(dates):
-        if i == 0:
-            prior_date = date
-            current_group = 0
-            groups_idxs.append(current_group)
-        else:
-            if(abs(prior_date - date)<timedelta):
-                groups_idxs.append(current_group)
-            else:
-                current_group = current_group + 1
-                groups_idxs.append(current_group)
-
-            prior_date = date
+    if(len(dates) == 0):
+        return([])
+    new_group = np.abs(np.diff(np.array(dates, dtype=object))) >= timedelta
+    return(np.concatenate([[0], np.cumsum(new_group)]).astype(int).tolist())
 
-    return(groups_idxs)
 
-
-def _get_image(bbox, time_interval, resolution):
+def _get_image(bbox, time_interval, resolution, data_folder="test_dir"):
     size = bbox_to_dimensions(bbox, resolution=resolution)
     request = SentinelHubRequest(
-        data_folder="test_dir",
+        data_folder=data_folder,
         evalscript=evalscripts.SENTINEL1,
         input_data=[
             SentinelHubRequest.input_data(
@@ -134,36 +105,62 @@ def _get_image(bbox, time_interval, resolution):
     )
     return(request)
 
+def _get_requests(bbox, time_interval, resolution, split_shape, tile_size, coverage=None, data_folder="test_dir"):
+    split_shape = resolve_split_shape(bbox, split_shape, resolution, tile_size)
+    if(split_shape is None):
+        bbox_list = [bbox]
+    else:
+        bbox_splitter = BBoxSplitter([ bbox], crs = CRS, split_shape = split_shape)
+        bbox_list = bbox_splitter.get_bbox_list()
+    if(coverage is not None):
+        bbox_list = catalog.prune_tiles(bbox_list, coverage)
+    sh_requests = [_get_image(bbox, time_interval, resolution, data_folder) for bbox in bbox_list]
+    return(sh_requests)
+
 def get_image(
         bbox, 
         time_interval, 
         resolution,
         split_shape = (10,10),
-        rate_limit=1
+        rate_limit=1,
+        max_threads=4,
+        cache_dir=None,
+        cache_size=CACHE_SIZE,
+        max_retry=10,
+        manifest=None,
+        tile_size=None
     ):
 
-    sh_requests = None
-
-    if(split_shape is None):
-        sh_requests = [_get_image(bbox, time_interval, resolution)]
-    else:
-        bbox_splitter = BBoxSplitter([ bbox], crs = CRS, split_shape = split_shape)
-        bbox_list = bbox_splitter.get_bbox_list()
-        sh_requests = [_get_image(bbox, time_interval, resolution) for bbox in bbox_list]
-
-    #dl_requests = [request.download_list[0] for request in sh_requests]
-    #_ = SentinelHubDownloadClient(config=None).download(dl_requests, max_threads=5)
-
-    for request in sh_requests:
-        dl_request = request.download_list[0]
-        _ = SentinelHubDownloadClient(config=None).download([dl_request], max_threads=1)
-        time.sleep(rate_limit)  # Pause for the specified time delay
-    
-    
-    tiffs = [Path(sh_requests[0].data_folder) / req.get_filename_list()[0] for req in sh_requests]
-    str_tiffs = [str(tiff) for tiff in tiffs]
+    sh_requests = _get_requests(bbox, time_interval, resolution, split_shape, tile_size)
+    str_tiffs = get_downloader(rate_limit, max_threads, cache_dir, cache_size).download(sh_requests, max_retry=max_retry, manifest=manifest)
     return(str_tiffs)
 
+"""
+Download the image writing the tiles directly in the output as they arrive, with the dataMask applied as NO_DATA.
+The tiles not intersecting the `coverage` geometry are not requested.
+"""
+def download(
+        bbox, 
+        time_interval, 
+        output,
+        resolution = RESOLUTION,
+        split_shape = (10,10),
+        rate_limit=1,
+        max_threads=4,
+        cache_dir=None,
+        cache_size=CACHE_SIZE,
+        max_retry=10,
+        manifest=None,
+        tile_size=None,
+        coverage=None,
+        data_folder="test_dir"
+    ):
+
+    sh_requests = _get_requests(bbox, time_interval, resolution, split_shape, tile_size, coverage, data_folder)
+    downloader = get_downloader(rate_limit, max_threads, cache_dir, cache_size)
+    with TileWriter(output, list(bbox), resolution, nodata=NO_DATA, dtype=np.float32, count=1) as writer:
+        downloader.download_into(sh_requests, writer, max_retry=max_retry, manifest=manifest)
+
 
 def subsample(groups, n):
     if(n<len(groups)):
@@ -174,35 +171,60 @@ def subsample(groups, n):
     return(ss_groups)
 
 
-def mosaic(bbox, start, end, output, n, max_retry = 10, split_shape=(10,10), rate_limit=1):
+def mosaic(bbox, start, end, output, n, max_retry = 10, split_shape=(10,10), rate_limit=1, max_threads=4, cache_dir=None, cache_size=CACHE_SIZE, resume=False, tile_size=None, memory_budget=None, queue_depth=1, group_requests=True, catalog_ttl=CATALOG_TTL, prune_tiles=False, scratch_dir=None, disk_budget=None, cog=False, cog_blocksize=BLOCK_SIZE, cog_compress=COMPRESS, cog_predictor=PREDICTOR, cube=None, cube_chunk_size=BLOCK_SIZE, compositing='mean', percentile=50, keep_state=False, append=False):
+
 
+    if(compositing not in COMPOSITING or compositing == 'best'):
+        raise Exception(f'Unknown compositing {compositing} for Sentinel-1, expected mean, median or percentile')
+    if((keep_state or append) and compositing != 'mean'):
+        raise Exception('The composite state is kept only for the mean compositing')
 
     time_interval =  [start, end]
     bbox = BBox(bbox=bbox, crs=CRS)
+    split_shape = resolve_split_shape(bbox, split_shape, RESOLUTION, tile_size)
+
+    dates, footprints = get_orbits(bbox, time_interval, cache_dir=cache_dir, catalog_ttl=catalog_ttl)
+
+    # with `keep_state`, the state of the composite is saved next to the output, and with `append`
+    # the new groups are added to the state saved by a previous run instead of starting from scratch
+    state_path = get_state_path(output)
+    run = json.loads(json.dumps({'bbox': list(bbox)}))
+    state = {'run': run, 'start': start.isoformat(), 'end': end.isoformat(), 'n': 0, 'dates': []}
+    if(append):
+        previous = read_state(state_path)
+        if(previous['run'] != run):
+            raise Exception(f'The composite state {state_path} was created with different parameters: {previous["run"]}')
+        state.update(start = previous['start'], n = previous['n'], dates = previous['dates'])
+
+        # only the acquisitions of the orbit of the previous run which are not in the composite yet
+        seen = set(previous['dates'])
+        for orbit in list(dates.keys()):
+            new = np.array([date.isoformat() not in seen for date in dates[orbit]], dtype=bool)
+            if(orbit != previous['orbit'] or not new.any()):
+                del dates[orbit]
+                del footprints[orbit]
+            else:
+                dates[orbit] = list(np.array(dates[orbit], dtype=object)[new])
+                footprints[orbit] = footprints[orbit][new]
+        if(len(dates) == 0):
+            print('No new acquisitions to add to {output}'.format(output = output))
 
-    dates, bboxes = get_orbits(bbox, time_interval)
     intersections = {}
     date_groups = {}
-    bbox_groups = {}
+    footprint_groups = {}
 
     for orbit in dates.keys():
 
-        groups_idxs = group_dates(dates[orbit])
+        groups_idxs = np.array(group_dates(dates[orbit]))
+        orbit_dates = np.array(dates[orbit], dtype=object)
+        date_groups[orbit] = [list(orbit_dates[groups_idxs == idx]) for idx in range(groups_idxs.max()+1)]
+        footprint_groups[orbit] = [footprints[orbit][groups_idxs == idx] for idx in range(groups_idxs.max()+1)]
 
-        date_groups[orbit] =  [[] for i in range(max(groups_idxs)+1)]
-        bbox_groups[orbit] =  [[] for i in range(max(groups_idxs)+1)]
-        
-        
-        for idx in range(len(groups_idxs)):
-            date_groups[orbit][groups_idxs[idx]].append(dates[orbit][idx])
-            bbox_groups[orbit][groups_idxs[idx]].append(bboxes[orbit][idx])
-
-        intersection_groups = []
-        for idx in range(len(bbox_groups[orbit])):
-            bbox_group_polygon = shapely.unary_union([bbox.geometry for bbox in bbox_groups[orbit][idx]])
-            intersection = bbox_group_polygon.intersection(bbox.geometry).area
-            intersection = intersection/bbox.geometry.area
-            intersection_groups.append(intersection)
+        # fraction of the bbox covered by each group
+        covered = shapely.intersection(footprints[orbit], bbox.geometry)
+        intersection_groups = [
+            shapely.union_all(covered[groups_idxs == idx]).area/bbox.geometry.area for idx in range(groups_idxs.max()+1)
+        ]
         intersections[orbit] = np.mean(intersection_groups)
 
     if len(intersections) == 1:
@@ -217,76 +239,128 @@ def mosaic(bbox, start, end, output, n, max_retry = 10, split_shape=(10,10), rat
     if orbit is not None:
         
         date_groups = date_groups[orbit]
-        bbox_groups = bbox_groups[orbit]
+        footprint_groups = footprint_groups[orbit]
         intersections = intersections[orbit]
         
         groups = subsample(date_groups, n = n)
-
-        merged_mask = None
-        merged_bands = None
-        files = []
-        for group_idx, group in enumerate(groups):
-
-            partial_outputs = []
-            cache_files = []
-            for timestamp_idx, timestamp in enumerate(group):
-                
-                partial_output = './image_{group_idx}_{timestamp_idx}.tiff'.format(group_idx=group_idx, timestamp_idx=timestamp_idx)
-                
-                tiffs = shretry(max_retry, get_image, bbox = bbox, time_interval = (timestamp - datetime.timedelta(hours=1), timestamp + datetime.timedelta(hours=1)), resolution = RESOLUTION, split_shape=split_shape, rate_limit=rate_limit)
-                cache_files.extend(tiffs)
-                
-                if(len(tiffs)>1):
-                    gdal_merge(tiffs, list(bbox), output=partial_output)
+        group_footprints = subsample(footprint_groups, n = n)
+
+        manifest = None
+        if(resume):
+            run = {'bbox': list(bbox), 'start': start, 'end': end, 'n': n, 'split_shape': split_shape, 'orbit': orbit, 'group_requests': group_requests, 'prune_tiles': prune_tiles}
+            manifest = RunManifest(output + '.manifest.json', run)
+
+        # the intermediates are written in the scratch space of the run, within the disk budget
+        with get_scratch(output, scratch_dir, disk_budget, resume) as scratch:
+            # the median, percentile and best pixel composites reduce the data cube, only the count of the valid observations is kept
+            compositor = Compositor(folder = None if memory_budget is None else scratch.folder, keep_sum = compositing == 'mean')
+            if(append):
+                compositor.load(state_path)
+
+            transform, width, height = get_output_grid(bbox, RESOLUTION)
+
+            # with `cube`, every group is also stored in the [time, band, y, x] data cube in the folder `cube`,
+            # the median and percentile composites are computed from the data cube (in the scratch space if not requested)
+            datacube = None
+            if(cube is not None or compositing != 'mean'):
+                attrs = {'transform': list(transform)[:6], 'crs': 'EPSG:4326', 'bands': ['VV'], 'orbit': orbit}
+                times = [[min(group).isoformat(), max(group).isoformat()] for group in groups]
+                datacube = DataCube(cube or scratch.path('cube'), times, (1, height, width), np.float32, NO_DATA, chunk_size=cube_chunk_size, attrs=attrs)
+
+            def get_path(group_idx):
+                return(scratch.path('image_{group_idx}.tiff'.format(group_idx=group_idx)))
+
+            # a group is downloaded only when its image (and its partial images) fit in the disk budget
+            def reserve(item, force):
+                group_idx, group = item
+                images = 1 if group_requests else len(group) + 1
+                return(scratch.reserve(get_path(group_idx), width*height*images*np.dtype(np.float32).itemsize, force))
+
+            def fetch(item):
+                group_idx, group = item
+                group_output = get_path(group_idx)
+                group_key = group[0].isoformat()
+
+                completed = manifest is not None and manifest.get('groups', group_key) is not None and os.path.exists(group_output)
+                # with `prune_tiles`, the tiles not intersecting the footprints of the group are not requested
+                coverage = shapely.union_all(group_footprints[group_idx]) if prune_tiles else None
+                if(not completed and group_requests):
+                    # the ORBIT mosaicking of the evalscript merges all the acquisitions of the group in a single request per tile
+                    time_interval = (group[0] - datetime.timedelta(hours=1), group[-1] + datetime.timedelta(hours=1))
+                    download(bbox = bbox, time_interval = time_interval, output = group_output, resolution = RESOLUTION, split_shape=split_shape, rate_limit=rate_limit, max_threads=max_threads, cache_dir=cache_dir, cache_size=cache_size, max_retry=max_retry, manifest=manifest, coverage=coverage, data_folder=scratch.path('tiles'))
+                elif(not completed):
+                    partial_outputs = []
+                    for timestamp_idx, timestamp in enumerate(group):
+
+                        partial_output = scratch.path('image_{group_idx}_{timestamp_idx}.tiff'.format(group_idx=group_idx, timestamp_idx=timestamp_idx))
+
+                        download(bbox = bbox, time_interval = (timestamp - datetime.timedelta(hours=1), timestamp + datetime.timedelta(hours=1)), output = partial_output, resolution = RESOLUTION, split_shape=split_shape, rate_limit=rate_limit, max_threads=max_threads, cache_dir=cache_dir, cache_size=cache_size, max_retry=max_retry, manifest=manifest, coverage=coverage, data_folder=scratch.path('tiles'))
+                        partial_outputs.append(partial_output)
+
+                    gdal_merge(partial_outputs, list(bbox), output=group_output, dstnodata=NO_DATA)
+
+                    for tiff in partial_outputs:
+                        os.remove(tiff)
+
+                if(manifest is not None and not completed):
+                    manifest.set('groups', group_key, group_output)
+                return(group_output)
+
+            # the next `queue_depth` groups are downloaded while the current one is processed
+            for (group_idx, group), group_output in prefetch(fetch, enumerate(groups), depth=queue_depth, reserve=reserve):
+                with rasterio.open(group_output, 'r') as file:
+                    if(compositor.count is None):
+                        compositor.allocate((file.count, file.height, file.width), file.dtypes[0])
+                    for window in get_windows(file, BYTES_PER_BAND*file.count, memory_budget):
+                        bands = file.read(window=window)
+                        compositor.add(bands, (bands!=NO_DATA).all(0), window=window)
+                        if(datacube is not None):
+                            datacube.write(group_idx, bands, window=window)
+                    compositor.next_image()
+                    profile = file.profile
+                    del bands
+                state['dates'].extend(date.isoformat() for date in group)
+
+                scratch.release(group_output, remove = manifest is None)  # kept to resume the run until it ends
+
+            if(datacube is not None):
+                datacube.close()
+
+            # with `cog`, the composite is written in the scratch space and copied to a Cloud-Optimized GeoTIFF
+            composite = scratch.path('composite.tiff') if cog else output
+            with rasterio.open(composite, 'w', **profile) as file:
+                if(compositing == 'mean'):
+                    for window in get_windows(file, BYTES_PER_BAND*file.count, memory_budget):
+                        file.write(compositor.mean(nodata=NO_DATA, dtype=np.float32, window=window), window=window)
                 else:
-                    shutil.copyfile(tiffs[0], partial_output)
-
-                partial_outputs.append(partial_output)
-
-            group_output = './image_{group_idx}.tiff'.format(group_idx=group_idx)
-            gdal_merge(partial_outputs, list(bbox), output=group_output, dstnodata=NO_DATA)
-            
-            with rasterio.open(group_output, 'r') as file:
-                bands = file.read()
-                mask  = bands[-1,  :, :]
-                bands = bands[:-1, :, :]
-                profile = file.profile
-
-            profile.update(count = bands.shape[0])
-            with rasterio.open(group_output, 'w', **profile) as file:
-                bands = np.array(bands).transpose((1,2,0))
-                bands[mask==0] = NO_DATA
-                bands = np.array(bands).transpose((2,0,1))
-                file.nodata = NO_DATA
-                file.write(bands)
-
-            bands[bands==NO_DATA] = np.nan
-            
-            mask = np.ones_like(bands)
-            mask[np.isnan(bands)] = 0
-            bands[np.isnan(bands)] = 0
-
-            if(merged_mask is None):
-                merged_mask = mask
-                merged_bands = bands
-            else:
-                merged_mask = merged_mask + mask
-                merged_bands = merged_bands + bands
-            
-            files.append(group_output)
-            
-            for tiff in partial_outputs:
-                os.remove(tiff)
-            #for tiff in cache_files:
-            #    os.remove(tiff)
-            #if(len(files)<len(groups)):
-            #    os.remove(group_output)
-
-        merged_mask[merged_mask==0] = np.nan
-        merged_bands = merged_bands/merged_mask
-        merged_bands[np.isnan(merged_bands)] = NO_DATA
-        
-        shutil.copyfile(files[-1], output)
-        with rasterio.open(output, 'r+') as file:
-            file.write(merged_bands)
-        os.remove(files[-1])
\ No newline at end of file
+                    # the windows hold the images of all the groups, without a memory budget they are the chunks of the data cube
+                    windows = get_blocks(file.width, file.height, cube_chunk_size) if memory_budget is None else get_windows(file, BYTES_PER_BAND*file.count*len(groups), memory_budget)
+                    for window in windows:
+                        file.write(datacube.composite(compositing, nodata=NO_DATA, dtype=np.float32, window=window, q=percentile), window=window)
+            if(cog):
+                write_cog(composite, output, blocksize=cog_blocksize, compress=cog_compress, predictor=cog_predictor, resampling='average')
+
+            if(keep_state):
+                state.update(orbit = orbit, n = state['n'] + len(groups))
+                compositor.save(state_path, state)
+
+            if(manifest is not None):
+                manifest.remove()
+
+
+"""
+Update a mosaic created with `keep_state` until `end`, downloading only the groups of the same orbit acquired
+after the end of the previous run and adding them to its saved composite.
+If `n` is not provided, the number of groups per day of the previous runs is kept.
+"""
+def update(output, end, n=None, **kwargs):
+    state = read_state(get_state_path(output))
+    previous_start = datetime.datetime.fromisoformat(state['start'])
+    start = datetime.datetime.fromisoformat(state['end'])
+    if(end <= start):
+        print('{output} is already updated until {start}'.format(output = output, start = start))
+        return
+    if(n is None):
+        n = max(1, int(round(state['n']*(end - start)/(start - previous_start))))
+
+    mosaic(state['run']['bbox'], start, end, output, n, keep_state=True, append=True, **kwargs)
\ No newline at end of file
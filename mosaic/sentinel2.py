@@ -13,21 +13,39 @@ import rasterio
 import numpy as np
 import shutil
 import os
-from mosaic.utils import shretry, gdal_merge, split_interval
-import time
+import json
+import datetime
+from mosaic.downloader import get_downloader
+from mosaic.cache import CACHE_SIZE
+from mosaic import catalog
+from mosaic.catalog import CATALOG_TTL
+from mosaic.manifest import RunManifest
+from mosaic.scratch import get_scratch
+from mosaic.raster import TileWriter, get_windows, get_blocks, get_output_grid, get_output_profile, get_window, write_cog, BLOCK_SIZE, COMPRESS, PREDICTOR
+from mosaic.compositor import Compositor, get_state_path, read_state
+from mosaic.cube import DataCube, COMPOSITING
+from mosaic.utils import split_interval, resolve_split_shape, prefetch
 
 NO_DATA = -9999
 RESOLUTION = 10
+BYTES_PER_BAND = 16  # peak memory per pixel and band used while processing a window
 CRS = sentinelhub.CRS.WGS84
 
 
-def download(bbox, time_interval, output, split_shape=(10, 10), rate_limit=1):
+"""
+Download the given bands of the image, writing the tiles directly in the output as they arrive.
+If `cloud_mask` is "CLP" or "CLM", the clouds detected by Sentinel Hub are NO_DATA.
+The tiles for which `is_covered(bbox)` is True, or not intersecting the `coverage` geometry, are not requested, and are NO_DATA.
+"""
+def download(bbox, time_interval, output, split_shape=(10, 10), rate_limit=1, max_threads=4, cache_dir=None, cache_size=CACHE_SIZE, max_retry=10, manifest=None, tile_size=None, bands=evalscripts.SENTINEL2_BANDS, cloud_mask=None, is_covered=None, coverage=None, data_folder="test_dir"):
+
+    evalscript = evalscripts.sentinel2(bands, cloud_mask)
 
     def get_image(bbox, resolution):
         size = bbox_to_dimensions(bbox, resolution=resolution)
         request = SentinelHubRequest(
-            data_folder="test_dir",
-            evalscript=evalscripts.SENTINEL2,
+            data_folder=data_folder,
+            evalscript=evalscript,
             input_data=[
                 SentinelHubRequest.input_data(
                     data_collection=DataCollection.SENTINEL2_L1C,
@@ -42,92 +60,233 @@ def download(bbox, time_interval, output, split_shape=(10, 10), rate_limit=1):
         )
         return(request)
 
+    split_shape = resolve_split_shape(bbox, split_shape, RESOLUTION, tile_size)
     bbox_splitter = BBoxSplitter(
         [ BBox(bbox, crs=CRS) ], crs = CRS, split_shape = split_shape
     )  # bounding box will be split into grid of row x columns bounding boxes
 
     bbox_list = bbox_splitter.get_bbox_list()
+    if(coverage is not None):
+        bbox_list = catalog.prune_tiles(bbox_list, coverage)
+    if(is_covered is not None):
+        bbox_list = [tile for tile in bbox_list if not is_covered(tile)]
     sh_requests = [get_image(bbox, RESOLUTION) for bbox in bbox_list]
     
-    #dl_requests = [request.download_list[0] for request in sh_requests]
-    #_ = SentinelHubDownloadClient(config=None).download(dl_requests, max_threads=5)
+    downloader = get_downloader(rate_limit, max_threads, cache_dir, cache_size)
+    with TileWriter(output, bbox, RESOLUTION, nodata=NO_DATA, dtype=np.int16, count=len(evalscripts.sort_bands(bands))) as writer:
+        downloader.download_into(sh_requests, writer, max_retry=max_retry, manifest=manifest)
+
 
-    for request in sh_requests:
-        dl_request = request.download_list[0]
-        _ = SentinelHubDownloadClient(config=None).download([dl_request], max_threads=1)
-        time.sleep(rate_limit)  # Pause for the specified time delay
+def mosaic(bbox, start, end, output, n, max_retry = 10, split_shape=(10, 10), mask_clouds = True, rate_limit=1, max_threads=4, cache_dir=None, cache_size=CACHE_SIZE, resume=False, tile_size=None, memory_budget=None, cloud_chunk_size=None, cloud_overlap=16, cloud_workers=1, cloud_resolution=None, bands=evalscripts.SENTINEL2_BANDS, cloud_mask="s2cloudless", queue_depth=1, min_observations=None, prune_tiles=False, catalog_ttl=CATALOG_TTL, scratch_dir=None, disk_budget=None, cog=False, cog_blocksize=BLOCK_SIZE, cog_compress=COMPRESS, cog_predictor=PREDICTOR, cube=None, cube_chunk_size=BLOCK_SIZE, compositing='mean', percentile=50, keep_state=False, append=False):
 
-    data_folder = sh_requests[0].data_folder
-    tiffs = [Path(data_folder) / req.get_filename_list()[0] for req in sh_requests]
-    str_tiffs = [str(tiff) for tiff in tiffs]
+    split_shape = resolve_split_shape(bbox, split_shape, RESOLUTION, tile_size)
 
-    gdal_merge(str_tiffs, bbox, output=output, dstnodata=NO_DATA)
-    for str_tiff in str_tiffs:
-        os.remove(str_tiff)
+    slots = split_interval(start, end, n)
 
+    # the clouds are detected locally by s2cloudless, or masked by Sentinel Hub with its CLP or CLM bands
+    if(cloud_mask != "s2cloudless" and cloud_mask not in evalscripts.CLOUD_MASKS):
+        raise Exception(f'Unknown cloud mask {cloud_mask}')
+    local_mask = mask_clouds and cloud_mask == "s2cloudless"
+    if(compositing not in COMPOSITING):
+        raise Exception(f'Unknown compositing {compositing}, expected one of {COMPOSITING}')
+    if(compositing == 'best' and not local_mask):
+        raise Exception('The best pixel compositing requires the cloud probability of s2cloudless')
+    if((keep_state or append) and compositing != 'mean'):
+        raise Exception('The composite state is kept only for the mean compositing')
+    server_mask = cloud_mask if mask_clouds and not local_mask else None
+    if(local_mask):
+        model = clouddetection.Inference(all_bands=False, chunk_size=cloud_chunk_size, overlap=cloud_overlap, workers=cloud_workers, resolution=cloud_resolution, image_resolution=RESOLUTION)
 
-def mosaic(bbox, start, end, output, n, max_retry = 10, split_shape=(10, 10), mask_clouds = True, rate_limit=1):
+    # only the requested bands and, when masking the clouds locally, the ones used by s2cloudless are downloaded
+    output_bands = evalscripts.sort_bands(bands)
+    download_bands = evalscripts.sort_bands(output_bands + (evalscripts.CLOUD_BANDS if local_mask else []))
+    output_idxs = [download_bands.index(band) for band in output_bands]
+    cloud_idxs = [download_bands.index(band) for band in evalscripts.CLOUD_BANDS] if local_mask else []
 
-    slots = split_interval(start, end, n)
-    model = clouddetection.Inference(all_bands=True)
+    manifest = None
+    if(resume):
+        run = {'bbox': list(bbox), 'start': start, 'end': end, 'n': n, 'split_shape': split_shape, 'mask_clouds': mask_clouds, 'cloud_mask': cloud_mask, 'bands': output_bands, 'min_observations': min_observations, 'prune_tiles': prune_tiles}
+        manifest = RunManifest(output + '.manifest.json', run)
     
-    merged_mask = None
-    merged_bands = None
+    # the intermediates are written in the scratch space of the run, within the disk budget
+    with get_scratch(output, scratch_dir, disk_budget, resume) as scratch:
+        # the median, percentile and best pixel composites reduce the data cube, only the count of the valid observations is kept
+        compositor = Compositor(folder = None if memory_budget is None else scratch.folder, keep_sum = compositing == 'mean')
 
-    files = []
-    for slot in slots:
-        print(slot)
-        image = './image_{start}_{end}.tiff'.format(start = slot[0], end = slot[1])
-        
-        shretry(max_retry, download, bbox = bbox, time_interval = slot, output = image, split_shape=split_shape, rate_limit=rate_limit)
-
-        with rasterio.open(image, 'r') as file:
-            bands = file.read()
-            mask  = bands[-1,  :, :]
-            bands = bands[:-1, :, :]
-            profile = file.profile
-
-        profile.update(count = bands.shape[0])
-        with rasterio.open(image, 'w', **profile) as file:
-            bands = np.array(bands).transpose((1,2,0))
-            if(mask_clouds==True):
-                tmp = bands.copy()
-                tmp[tmp==NO_DATA] = 0
-                tmp = tmp.astype(np.float32)/10000.0
-                cloud_prob = model.predict(tmp[np.newaxis, ...])[0, :, :]
-                bands[cloud_prob > 0.4] = NO_DATA
-
-            bands[mask==0] = NO_DATA
-            bands = np.array(bands).transpose((2,0,1))
-            file.nodata = NO_DATA
-            file.write(bands)
-        
-        bands = bands.astype(np.float32)
-        bands[bands==NO_DATA] = np.nan
-        mask = np.ones_like(bands)
-        mask[np.isnan(bands)] = 0
-        bands[np.isnan(bands)] = 0
-        bands = bands.astype(np.int16)
-
-        if(merged_mask is None):
-            merged_mask = mask
-            merged_bands = bands
-        else:
-            merged_mask = merged_mask + mask
-            merged_bands = merged_bands + bands
+        # with `min_observations`, only the tiles having pixels with less valid observations are requested
+        transform, width, height = get_output_grid(bbox, RESOLUTION)
+
+        # with `keep_state`, the state of the composite is saved next to the output, and with `append`
+        # the new slots are added to the state saved by a previous run instead of starting from scratch
+        state_path = get_state_path(output)
+        run = json.loads(json.dumps({'bbox': list(bbox), 'mask_clouds': mask_clouds, 'cloud_mask': cloud_mask, 'bands': output_bands}))
+        state = {'run': run, 'start': start.isoformat(), 'end': end.isoformat(), 'n': 0, 'slots': []}
+        if(append):
+            previous = compositor.load(state_path)
+            if(previous['run'] != run):
+                raise Exception(f'The composite state {state_path} was created with different parameters: {previous["run"]}')
+            state.update(start = previous['start'], n = previous['n'], slots = previous['slots'])
+            slots = [slot for slot in slots if list(slot) not in previous['slots']]
+            if(len(slots) == 0):
+                print('No new slots to add to {output}'.format(output = output))
+                return
+
+        def is_covered(tile):
+            if(min_observations is None or compositor.count is None):
+                return(False)
+            rows, cols = get_window(list(tile), transform, width, height).toslices()
+            return(bool(compositor.count[rows, cols].min() >= min_observations))
+
+        # with `cube`, every slot is also stored in the [time, band, y, x] data cube in the folder `cube`,
+        # the median, percentile and best pixel composites are computed from the data cube (in the scratch space if not requested)
+        datacube = None
+        if(cube is not None or compositing != 'mean'):
+            attrs = {'transform': list(transform)[:6], 'crs': 'EPSG:4326', 'bands': output_bands}
+            datacube = DataCube(cube or scratch.path('cube'), slots, (len(output_idxs), height, width), np.int16, NO_DATA, chunk_size=cube_chunk_size, attrs=attrs)
+        # the best pixel is the valid observation with the lowest cloud probability
+        scores = None
+        if(compositing == 'best'):
+            scores = DataCube(scratch.path('cloud_probability'), slots, (1, height, width), np.float32, np.nan, chunk_size=cube_chunk_size)
+
+        def get_path(slot):
+            return(scratch.path('image_{start}_{end}.tiff'.format(start = slot[0], end = slot[1])))
+
+        # when resuming, the clouds of the completed slots are not detected again: their cloud probability
+        # is kept next to their image, such that they are ranked as in an uninterrupted run
+        keep_scores = scores is not None and manifest is not None
+        def get_scores_path(slot):
+            return(scratch.path('cloud_probability_{start}_{end}.npy'.format(start = slot[0], end = slot[1])))
+
+        # a slot is downloaded only when its image fits in the disk budget
+        def reserve(slot, force):
+            nbytes = width*height*len(download_bands)*np.dtype(np.int16).itemsize
+            if(keep_scores):
+                nbytes = nbytes + width*height*np.dtype(np.float32).itemsize
+            return(scratch.reserve(get_path(slot), nbytes, force))
+
+        def fetch(slot):
+            image = get_path(slot)
+            slot_key = '{start}_{end}'.format(start = slot[0], end = slot[1])
+
+            if(min_observations is not None and compositor.count is not None and compositor.count.min() >= min_observations):
+                return(None, slot_key, False)  # all the tiles are already covered
+
+            completed = manifest is not None and manifest.get('slots', slot_key) is not None and os.path.exists(image)
+            completed = completed and (not keep_scores or os.path.exists(get_scores_path(slot)))
+            if(not completed):
+                # with `prune_tiles`, the tiles without any acquisition in the catalog are not requested
+                coverage = None
+                if(prune_tiles):
+                    folder = None if cache_dir is None else os.path.join(cache_dir, 'catalog')
+                    coverage = catalog.get_coverage(DataCollection.SENTINEL2_L1C, BBox(bbox, crs=CRS), slot, folder=folder, ttl=catalog_ttl)
+                download(bbox = bbox, time_interval = slot, output = image, split_shape=split_shape, rate_limit=rate_limit, max_threads=max_threads, cache_dir=cache_dir, cache_size=cache_size, max_retry=max_retry, manifest=manifest, bands=download_bands, cloud_mask=server_mask, is_covered=is_covered, coverage=coverage, data_folder=scratch.path('tiles'))
+            return(image, slot_key, completed)
+
+        # the next `queue_depth` slots are downloaded while the current one is processed,
+        # with `min_observations` the tiles of a slot are chosen once the previous slots are composited
+        if(min_observations is not None and queue_depth > 0):
+            print('The slots are downloaded one at a time to request only the tiles without {n} valid observations'.format(n = min_observations))
+            queue_depth = 0
+        files = []
+        for slot, (image, slot_key, completed) in prefetch(fetch, slots, depth=queue_depth, reserve=reserve):
+            print(slot)
+            if(image is None):
+                scratch.release(get_path(slot))
+                break
+            slot_scores = None
+            if(keep_scores and completed):
+                slot_scores = np.load(get_scores_path(slot), mmap_mode='r')
+            elif(keep_scores):
+                slot_scores = np.lib.format.open_memmap(get_scores_path(slot), mode='w+', dtype=np.float32, shape=(1, height, width))
+                slot_scores[:] = np.nan
+            with rasterio.open(image, 'r+') as file:
+                if(compositor.count is None):
+                    compositor.allocate((len(output_idxs), file.height, file.width), file.dtypes[0])
+
+                for window in get_windows(file, BYTES_PER_BAND*file.count, memory_budget):
+                    bands = file.read(window=window)
+                    if(slot_scores is not None and completed):
+                        rows, cols = window.toslices()
+                        scores.write(slots.index(slot), slot_scores[:, rows, cols], window=window)
+                    if(local_mask and not completed and (bands != NO_DATA).any()):
+                        bands = np.array(bands).transpose((1,2,0))
+                        tmp = bands[:, :, cloud_idxs]
+                        tmp[tmp==NO_DATA] = 0
+                        tmp = tmp.astype(np.float32)/10000.0
+                        cloud_prob = model.predict(tmp[np.newaxis, ...])[0, :, :]
+                        bands[cloud_prob > 0.4] = NO_DATA
+                        if(scores is not None):
+                            scores.write(slots.index(slot), cloud_prob[np.newaxis, ...], window=window)
+                        if(slot_scores is not None):
+                            rows, cols = window.toslices()
+                            slot_scores[0, rows, cols] = cloud_prob
+                        bands = np.array(bands).transpose((2,0,1))
+                        file.write(bands, window=window)
+
+                    bands = bands[output_idxs]
+                    compositor.add(bands, (bands!=NO_DATA).all(0), window=window)
+                    if(datacube is not None):
+                        datacube.write(slots.index(slot), bands, window=window)
+                compositor.next_image()
+                del bands
+            state['slots'].append(list(slot))
+
+            if(slot_scores is not None and not completed):
+                slot_scores.flush()
+            del slot_scores
+            if(manifest is not None and not completed):
+                manifest.set('slots', slot_key, image)
         
-        files.append(image)
-        if(len(files)<len(slots)):
-            os.remove(image)
+            files.append(image)
+            scratch.release(image, remove = manifest is None)  # kept to resume the run until it ends
+
+            if(min_observations is not None and compositor.count.min() >= min_observations):
+                print('Every pixel has at least {n} valid observations, the remaining slots are skipped'.format(n = min_observations))
+                break
 
+        if(local_mask):
+            model.close()  # the workers of the cloud detection are kept between the windows and the slots
+        if(datacube is not None):
+            datacube.close()
     
-    merged_bands = merged_bands.astype(np.float32)    
-    merged_mask[merged_mask==0] = np.nan
-    merged_bands = merged_bands/merged_mask
-    merged_bands[np.isnan(merged_bands)] = NO_DATA
-    merged_bands = merged_bands.astype(np.int16)
-
-    shutil.copyfile(files[-1], output)
-    with rasterio.open(output, 'r+') as file:
-        file.write(merged_bands)
-    os.remove(files[-1])
\ No newline at end of file
+        # with `cog`, the composite is written in the scratch space and copied to a Cloud-Optimized GeoTIFF
+        composite = scratch.path('composite.tiff') if cog else output
+        # the profile does not depend on the slots, none of them is downloaded when the saved state already has `min_observations`
+        profile = get_output_profile(bbox, RESOLUTION, count = len(output_idxs), dtype = np.int16, nodata = NO_DATA)
+        with rasterio.open(composite, 'w', **profile) as file:
+            if(compositing == 'mean'):
+                for window in get_windows(file, BYTES_PER_BAND*file.count, memory_budget):
+                    file.write(compositor.mean(nodata=NO_DATA, dtype=np.int16, window=window), window=window)
+            else:
+                # the windows hold the images of all the slots, without a memory budget they are the chunks of the data cube
+                windows = get_blocks(file.width, file.height, cube_chunk_size) if memory_budget is None else get_windows(file, BYTES_PER_BAND*file.count*len(slots), memory_budget)
+                for window in windows:
+                    file.write(datacube.composite(compositing, nodata=NO_DATA, dtype=np.int16, window=window, q=percentile, scores=scores), window=window)
+        if(cog):
+            write_cog(composite, output, blocksize=cog_blocksize, compress=cog_compress, predictor=cog_predictor, resampling='average')
+
+        if(keep_state):
+            state['n'] = state['n'] + n
+            compositor.save(state_path, state)
+
+        if(manifest is not None):
+            manifest.remove()
+
+
+"""
+Update a mosaic created with `keep_state` until `end`, downloading only the slots after the end of the previous run
+and adding them to its saved composite. The parameters of the previous run (bbox, bands, cloud mask) are kept,
+and if `n` is not provided the new slots have the same length as the previous ones.
+"""
+def update(output, end, n=None, **kwargs):
+    state = read_state(get_state_path(output))
+    previous_start = datetime.datetime.fromisoformat(state['start'])
+    start = datetime.datetime.fromisoformat(state['end'])
+    if(end <= start):
+        print('{output} is already updated until {start}'.format(output = output, start = start))
+        return
+    if(n is None):
+        n = max(1, int(round(state['n']*(end - start)/(start - previous_start))))
+
+    run = state['run']
+    mosaic(run['bbox'], start, end, output, n, mask_clouds=run['mask_clouds'], cloud_mask=run['cloud_mask'], bands=run['bands'], keep_state=True, append=True, **kwargs)
\ No newline at end of file
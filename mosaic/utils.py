@@ -2,9 +2,16 @@
 Utility functions used by the other modules.
 """
 
-import subprocess
 import os
 import time
+import random
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from sentinelhub import BBox, BBoxSplitter, CRS, bbox_to_dimensions
+from mosaic import raster
+
+MAX_SIZE = 2500  # max width and height (in pixels) of a SentinelHub Process API request
 
 
 """
@@ -31,29 +38,96 @@ def shretry(max_retry, fun, **args):
     
     raise Exception(f'Execution unsuccessful')
 
+"""
+Retry multiple time the execution of a function with a set of parameters in input,
+waiting an exponentially increasing time between the attempts. The wait is randomized (full jitter)
+so that concurrent failures do not retry all at the same time.
+"""
+def backoff_retry(max_retry, fun, base_delay=1, max_delay=60, **args):
+    for attempt in range(1,max_retry+1):
+        try:
+            return(fun(**args))
+        except Exception as e:
+            print(f"attempt {attempt} failed: {e}" )
+            if(attempt < max_retry):
+                time.sleep(random.uniform(0, min(max_delay, base_delay*2**(attempt-1))))
+
+    raise Exception(f'Execution unsuccessful')
+
 
 """
-Wrapper around the execution of the merge of multiple images, using the GDAL library.
+Choose the smallest grid of tiles (columns, rows) such that every tile of the bounding box
+fits in a single request of at most `max_size` pixels per side, or in `tile_size` pixels per side if provided.
 """
-def gdal_merge(tiffs, bbox, output, dstnodata = None):
+def plan_split_shape(bbox, resolution, max_size=MAX_SIZE, tile_size=None):
+    if(not isinstance(bbox, BBox)):
+        bbox = BBox(bbox, crs=CRS.WGS84)
 
-    filelist = 'input.txt'
-    with open(filelist, 'w') as f:
-        for tiff in tiffs:
-            f.write(tiff+'\n')
+    size = max_size if tile_size is None else min(tile_size, max_size)
+    width, height = bbox_to_dimensions(bbox, resolution=resolution)
+    split_shape = (max(1, math.ceil(width/size)), max(1, math.ceil(height/size)))
 
-    
-    command = 'gdalwarp{args} -overwrite -s_srs EPSG:4326 -t_srs EPSG:4326 -te {min_lon} {min_lat} {max_lon} {max_lat} --optfile {tiffs} {output}'
-    if(dstnodata is not None):
-        args = ' -dstnodata {dstnodata}'.format(dstnodata=dstnodata)
-    else:
-        args = ''
-    command = command.format(args = args, min_lon = bbox[0], min_lat = bbox[1], max_lon = bbox[2], max_lat = bbox[3], tiffs = filelist, output = output)
+    # the size of each tile is computed in its own UTM zone, so it can slightly differ from the estimate
+    while True:
+        bbox_list = BBoxSplitter([bbox], crs=bbox.crs, split_shape=split_shape).get_bbox_list()
+        dimensions = [bbox_to_dimensions(tile, resolution=resolution) for tile in bbox_list]
+        columns = split_shape[0] + int(max(dimension[0] for dimension in dimensions) > size)
+        rows = split_shape[1] + int(max(dimension[1] for dimension in dimensions) > size)
+        if((columns, rows) == split_shape):
+            return(split_shape)
+        split_shape = (columns, rows)
+
+"""
+Return the split shape to use for a bounding box: `split_shape` can be a tuple (columns, rows),
+or "auto" to plan it with `plan_split_shape`.
+"""
+def resolve_split_shape(bbox, split_shape, resolution, tile_size=None):
+    if(split_shape == 'auto'):
+        split_shape = plan_split_shape(bbox, resolution, tile_size=tile_size)
+        print(f"split shape: {split_shape}")
+    return(split_shape)
+
+"""
+Merge of multiple images on the grid defined by the bounding box, using the GDAL library through rasterio.
+The merge is executed in process: no list file is written and no gdalwarp subprocess is spawned.
+"""
+def gdal_merge(tiffs, bbox, output, dstnodata = None):
+    return(raster.merge(tiffs, bbox, output, dstnodata=dstnodata))
 
-    print(command)
-    os.system(command)
-    os.remove(filelist)
-    return(output)
 
+"""
+Apply `fun` to the items in a background thread, up to `depth` items ahead of the one being consumed,
+yielding the items with their result in order. So the next items are downloaded while the current one is processed,
+and at most `depth` results are waiting to be consumed. If `depth` is 0, the items are processed in sequence.
+If `reserve` is provided, an item is submitted only when `reserve(item, force)` returns True,
+otherwise it is retried after the consumption of the current item. `force` is True when nothing else is in progress,
+and the item must be reserved anyway.
+"""
+def prefetch(fun, items, depth=1, reserve=None):
+    if(depth <= 0):
+        for item in items:
+            if(reserve is not None):
+                reserve(item, True)
+            yield(item, fun(item))
+        return
+
+    items = list(items)
+    executor = ThreadPoolExecutor(max_workers=1)
+    futures = deque()
 
+    def submit(start):
+        while(start < len(items) and len(futures) <= depth):
+            if(reserve is not None and not reserve(items[start], len(futures) == 0)):
+                break
+            futures.append((items[start], executor.submit(fun, items[start])))
+            start = start + 1
+        return(start)
 
+    try:
+        submitted = submit(0)
+        while(len(futures) > 0):
+            item, future = futures.popleft()
+            yield(item, future.result())
+            submitted = submit(submitted)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
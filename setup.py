@@ -14,5 +14,8 @@ setup(
         's2cloudless',
         'pytest',
         'dynamicworld @ git+https://github.com/DeepCube-org/dynamicworld.git',            
-    ]
+    ],
+    extras_require={
+        'cube': ['zarr'],  # chunked and compressed data cube, otherwise an uncompressed .npy file
+    }
 )
\ No newline at end of file
@@ -0,0 +1,69 @@
+import os
+
+from sentinelhub import BBox, CRS, DataCollection, MimeType, MosaickingOrder, SentinelHubRequest
+
+from mosaic.cache import TileCache, tile_key
+
+
+def make_request(bbox, time_interval=('2021-01-01', '2021-02-01'), evalscript='//VERSION=3', size=(10, 10)):
+    return SentinelHubRequest(
+        data_folder='test_dir',
+        evalscript=evalscript,
+        input_data=[
+            SentinelHubRequest.input_data(
+                data_collection=DataCollection.SENTINEL2_L1C,
+                time_interval=time_interval,
+                mosaicking_order=MosaickingOrder.LEAST_CC
+            )
+        ],
+        responses=[SentinelHubRequest.output_response("default", MimeType.TIFF)],
+        bbox=BBox(bbox, crs=CRS.WGS84),
+        size=size,
+        config=None,
+    )
+
+
+def write(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'0'*size)
+    return(path)
+
+
+def test_tile_key():
+    bbox = (46.00, -16.15, 46.05, -16.01)
+    key = tile_key(make_request(bbox))
+
+    assert key == tile_key(make_request(bbox))
+    assert key != tile_key(make_request((46.00, -16.15, 46.06, -16.01)))
+    assert key != tile_key(make_request(bbox, time_interval=('2021-01-01', '2021-03-01')))
+    assert key != tile_key(make_request(bbox, evalscript='//VERSION=3\n'))
+    assert key != tile_key(make_request(bbox, size=(20, 20)))
+
+
+def test_lru_eviction(tmp_path):
+    cache = TileCache(tmp_path / 'cache', max_bytes=250)
+
+    a = cache.put('aa', write(str(tmp_path / 'a.tiff'), 100))
+    b = cache.put('bb', write(str(tmp_path / 'b.tiff'), 100))
+    cache.unpin(a)
+    cache.unpin(b)
+
+    assert cache.get('aa') == a  # a becomes the most recently used
+    cache.unpin(a)
+
+    c = cache.put('cc', write(str(tmp_path / 'c.tiff'), 100))
+    assert os.path.exists(a) and os.path.exists(c)
+    assert not os.path.exists(b), 'the least recently used tile must be evicted'
+    assert cache.get('bb') is None
+
+
+def test_pinned_tiles_are_not_evicted(tmp_path):
+    cache = TileCache(tmp_path / 'cache', max_bytes=150)
+
+    a = cache.put('aa', write(str(tmp_path / 'a.tiff'), 100))
+    b = cache.put('bb', write(str(tmp_path / 'b.tiff'), 100))
+    assert os.path.exists(a) and os.path.exists(b)
+
+    cache.unpin(a)
+    assert not os.path.exists(a)
+    assert os.path.exists(b)
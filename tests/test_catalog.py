@@ -0,0 +1,54 @@
+from unittest import mock
+
+from sentinelhub import BBox, CRS, DataCollection
+
+from mosaic import catalog
+
+bbox = BBox((46.00, -16.15, 46.05, -16.01), crs=CRS.WGS84)
+time_interval = ('2021-01-01', '2021-02-01')
+
+
+def search(folder, ttl, results):
+    with mock.patch.object(catalog, 'SentinelHubCatalog') as sh_catalog:
+        sh_catalog.return_value.search.return_value = iter(results)
+        found = catalog.search(DataCollection.SENTINEL1_IW_DES, bbox, time_interval, folder=folder, ttl=ttl)
+    return(found, sh_catalog.return_value.search.call_count)
+
+
+def test_search_is_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, '_RESULTS', {})
+
+    assert search(str(tmp_path), 3600, [{'id': 'a'}]) == ([{'id': 'a'}], 1)
+    assert search(str(tmp_path), 3600, [{'id': 'b'}]) == ([{'id': 'a'}], 0)
+
+    # the results on disk are used by a new process
+    monkeypatch.setattr(catalog, '_RESULTS', {})
+    assert search(str(tmp_path), 3600, [{'id': 'b'}]) == ([{'id': 'a'}], 0)
+
+
+def test_search_expires(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, '_RESULTS', {})
+
+    assert search(str(tmp_path), 3600, [{'id': 'a'}]) == ([{'id': 'a'}], 1)
+    assert search(str(tmp_path), 0, [{'id': 'b'}]) == ([{'id': 'b'}], 1)
+
+
+def test_search_key():
+    key = catalog.search_key(DataCollection.SENTINEL1_IW_DES, bbox, time_interval)
+    assert key == catalog.search_key(DataCollection.SENTINEL1_IW_DES, bbox, time_interval)
+    assert key != catalog.search_key(DataCollection.SENTINEL1_IW_ASC, bbox, time_interval)
+    assert key != catalog.search_key(DataCollection.SENTINEL1_IW_DES, bbox, ('2021-01-01', '2021-03-01'))
+
+
+def test_prune_tiles():
+    tiles = [BBox((0, 0, 1, 1), crs=CRS.WGS84), BBox((1, 0, 2, 1), crs=CRS.WGS84), BBox((5, 5, 6, 6), crs=CRS.WGS84)]
+    footprint = {
+        'geometry': {
+            'type': 'Polygon',
+            'crs': {'type': 'name', 'properties': {'name': 'urn:ogc:def:crs:OGC::CRS84'}},
+            'coordinates': [[[0.5, 0.5], [1.5, 0.5], [1.5, 0.8], [0.5, 0.8], [0.5, 0.5]]],
+        }
+    }
+    coverage = catalog.get_footprints([footprint])[0]
+
+    assert catalog.prune_tiles(tiles, coverage) == tiles[:2]
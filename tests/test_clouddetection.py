@@ -0,0 +1,48 @@
+import numpy as np
+from mosaic.clouddetection import Inference
+
+
+def test_chunked_inference_matches_full_image():
+    image = np.random.default_rng(0).uniform(0, 0.5, size=(1, 70, 90, 13)).astype(np.float32)
+
+    expected = Inference(all_bands=True).predict(image)
+    chunked = Inference(all_bands=True, chunk_size=32, overlap=4).predict(image)
+
+    assert chunked.shape == expected.shape
+    np.testing.assert_allclose(chunked, expected, atol=1e-6)
+
+
+def test_parallel_inference_matches_full_image():
+    image = np.random.default_rng(1).uniform(0, 0.5, size=(1, 50, 40, 13)).astype(np.float32)
+
+    expected = Inference(all_bands=True).predict(image)
+    parallel = Inference(all_bands=True, chunk_size=20, overlap=4, workers=2).predict(image)
+
+    np.testing.assert_allclose(parallel, expected, atol=1e-6)
+
+
+def test_reduced_resolution_inference():
+    image = np.full((1, 60, 45, 13), 0.2, dtype=np.float32)
+    image[:, :30] = 0.05
+
+    expected = Inference(all_bands=True).predict(image)
+    reduced = Inference(all_bands=True, resolution=60, image_resolution=10).predict(image)
+
+    assert reduced.shape == expected.shape
+    # away from the edge between the two halves, the probabilities of uniform areas do not change
+    np.testing.assert_allclose(reduced[:, :20], expected[:, :20], atol=1e-5)
+    np.testing.assert_allclose(reduced[:, 40:], expected[:, 40:], atol=1e-5)
+
+
+def test_pool_is_reused():
+    rng = np.random.default_rng(2)
+    first = rng.uniform(0, 0.5, size=(1, 50, 40, 13)).astype(np.float32)
+    second = rng.uniform(0, 0.5, size=(1, 30, 40, 13)).astype(np.float32)
+
+    with Inference(all_bands=True, chunk_size=20, overlap=4, workers=2) as model:
+        np.testing.assert_allclose(model.predict(first), Inference(all_bands=True).predict(first), atol=1e-6)
+        executor = model.executor
+        np.testing.assert_allclose(model.predict(second), Inference(all_bands=True).predict(second), atol=1e-6)
+        np.testing.assert_allclose(model.predict(first), Inference(all_bands=True).predict(first), atol=1e-6)
+        assert model.executor is executor
+    assert model.executor is None and model.image_shm is None
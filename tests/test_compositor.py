@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from mosaic.compositor import Compositor, read_state, MAX_IMAGES
+
+
+def test_mean_of_valid_observations():
+    compositor = Compositor()
+
+    first = np.array([[[100, 200]], [[10, 20]]], dtype=np.int16)
+    second = np.array([[[300, -9999]], [[30, -9999]]], dtype=np.int16)
+    compositor.add(first, np.array([[True, True]]))
+    compositor.add(second, np.array([[True, False]]))
+
+    assert compositor.count.dtype == np.uint16
+    assert compositor.count.tolist() == [[2, 1]]
+
+    mean = compositor.mean(nodata=-9999, dtype=np.int16)
+    assert mean.dtype == np.int16
+    assert mean.tolist() == [[[200, 200]], [[20, 20]]]
+
+
+def test_sum_does_not_overflow():
+    compositor = Compositor()
+    bands = np.full((1, 2, 2), 30000, dtype=np.int16)
+    for _ in range(5):
+        compositor.add(bands, np.ones((2, 2), dtype=bool))
+
+    assert (compositor.mean(nodata=-9999, dtype=np.int16) == 30000).all()
+
+
+def test_pixels_without_observations_are_nodata():
+    compositor = Compositor()
+    compositor.add(np.ones((3, 2, 2), dtype=np.float32), np.array([[True, False], [False, False]]))
+
+    mean = compositor.mean(nodata=-9999)
+    assert (mean[:, 0, 0] == 1).all()
+    assert (mean[:, 1, :] == -9999).all()
+
+
+def test_too_many_images():
+    compositor = Compositor()
+    for _ in range(MAX_IMAGES):
+        compositor.add(np.ones((1, 1, 1), dtype=np.int16), np.ones((1, 1), dtype=bool))
+    assert compositor.count.tolist() == [[MAX_IMAGES]]
+    with pytest.raises(Exception):
+        compositor.add(np.ones((1, 1, 1), dtype=np.int16), np.ones((1, 1), dtype=bool))
+
+
+def test_windowed_memory_mapped_composite(tmp_path):
+    from rasterio.windows import Window
+
+    images = [np.random.randint(0, 1000, size=(2, 6, 5)).astype(np.int16) for _ in range(3)]
+    windows = [Window(0, 0, 5, 4), Window(0, 4, 5, 2)]
+
+    full = Compositor()
+    windowed = Compositor(folder=str(tmp_path))
+    windowed.allocate((2, 6, 5), np.int16)
+    for image in images:
+        valid = image[0] > 300
+        full.add(image, valid)
+        for window in windows:
+            rows, cols = window.toslices()
+            windowed.add(image[:, rows, cols], valid[rows, cols], window=window)
+        windowed.next_image()
+
+    assert isinstance(windowed.sum, np.memmap)
+    expected = full.mean(nodata=-9999, dtype=np.int16)
+    for window in windows:
+        rows, cols = window.toslices()
+        assert (windowed.mean(nodata=-9999, dtype=np.int16, window=window) == expected[:, rows, cols]).all()
+
+
+def test_save_and_load(tmp_path):
+    compositor = Compositor()
+    compositor.add(np.full((2, 2, 2), 10, dtype=np.int16), np.array([[True, False], [True, True]]))
+    compositor.save(str(tmp_path / 'state'), {'slots': [['2020-01-01', '2020-02-01']]})
+    compositor.add(np.full((2, 2, 2), 99, dtype=np.int16), np.ones((2, 2), dtype=bool))
+    compositor.save(str(tmp_path / 'state'), {'slots': [['2020-01-01', '2020-02-01'], ['2020-02-01', '2020-03-01']]})
+
+    assert read_state(str(tmp_path / 'state'))['slots'][1] == ['2020-02-01', '2020-03-01']
+    loaded = Compositor(folder=str(tmp_path / 'scratch'))
+    metadata = loaded.load(str(tmp_path / 'state'))
+    assert len(metadata['slots']) == 2
+    assert loaded.n == 2
+    assert (loaded.sum == compositor.sum).all()
+    assert (loaded.count == compositor.count).all()
+
+    loaded.add(np.full((2, 2, 2), 20, dtype=np.int16), np.ones((2, 2), dtype=bool))
+    assert loaded.mean(nodata=-9999, dtype=np.int16)[0].tolist() == [[43, 59], [43, 43]]
+
+
+def test_missing_state(tmp_path):
+    with pytest.raises(Exception):
+        read_state(str(tmp_path / 'state'))
+
+
+def test_count_only():
+    compositor = Compositor(keep_sum=False)
+    compositor.add(np.ones((13, 4, 4), dtype=np.int16), np.eye(4, dtype=bool))
+
+    assert compositor.sum is None
+    assert compositor.count.tolist() == np.eye(4, dtype=np.uint16).tolist()
+
+
+def test_state_beyond_255_images(tmp_path):
+    compositor = Compositor()
+    bands = np.full((1, 1, 1), 7, dtype=np.int16)
+    for _ in range(200):
+        compositor.add(bands, np.ones((1, 1), dtype=bool))
+    compositor.save(str(tmp_path / 'state'))
+
+    updated = Compositor()
+    updated.load(str(tmp_path / 'state'))
+    for _ in range(200):
+        updated.add(bands, np.ones((1, 1), dtype=bool))
+
+    assert updated.n == 400
+    assert updated.count.tolist() == [[400]]
+    assert updated.mean(nodata=-9999, dtype=np.int16).tolist() == [[[7]]]
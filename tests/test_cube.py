@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+import rasterio.windows
+
+from mosaic import cube as datacube
+from mosaic.compositor import Compositor
+from mosaic.cube import DataCube, open_cube
+
+
+def test_write_by_window_and_read(tmp_path):
+    times = [('2020-01-01', '2020-02-01'), ('2020-02-01', '2020-03-01'), ('2020-03-01', '2020-04-01')]
+    image = np.arange(2*4*6, dtype=np.int16).reshape(2, 4, 6)
+    with DataCube(str(tmp_path / 'cube'), times, (2, 4, 6), np.int16, -9999, chunk_size=2, attrs={'bands': ['B04', 'B08']}) as cube:
+        cube.write(0, image[:, :2], window=rasterio.windows.Window(0, 0, 6, 2))
+        cube.write(0, image[:, 2:], window=rasterio.windows.Window(0, 2, 6, 2))
+        cube.write(2, image + 1)
+
+    cube = open_cube(str(tmp_path / 'cube'))
+    assert cube.shape == (3, 2, 4, 6)
+    assert cube.times[1] == ['2020-02-01', '2020-03-01']
+    assert cube.attrs['bands'] == ['B04', 'B08']
+    assert cube.written == [True, False, True]
+    assert (cube.read()[0] == image).all()
+    assert (cube.read()[1] == -9999).all(), 'the images never written are nodata'
+    assert (cube.read(window=rasterio.windows.Window(1, 1, 2, 2), times=[2]) == image[np.newaxis, :, 1:3, 1:3] + 1).all()
+
+
+def test_mean_matches_compositor(tmp_path):
+    rng = np.random.default_rng(0)
+    compositor = Compositor()
+    with DataCube(str(tmp_path / 'cube'), range(4), (3, 5, 5), np.int16, -9999) as cube:
+        for index in range(4):
+            bands = rng.integers(0, 1000, (3, 5, 5)).astype(np.int16)
+            bands[:, rng.random((5, 5)) < 0.3] = -9999
+            compositor.add(bands, (bands != -9999).all(0))
+            cube.write(index, bands)
+
+        expected = compositor.mean(nodata=-9999, dtype=np.float32)
+        assert np.allclose(cube.mean(nodata=-9999), expected)
+
+
+def test_nan_nodata(tmp_path):
+    with DataCube(str(tmp_path / 'cube'), range(2), (1, 2, 2), np.float32, np.nan) as cube:
+        cube.write(0, np.array([[[0.5, np.nan], [0.25, np.nan]]], dtype=np.float32))
+
+    cube = open_cube(str(tmp_path / 'cube'))
+    assert np.isnan(cube.nodata)
+    mean = cube.mean(nodata=np.nan)
+    assert mean[0, :, 0].tolist() == [0.5, 0.25]
+    assert np.isnan(mean[0, :, 1]).all()
+
+
+def test_without_zarr(tmp_path, monkeypatch):
+    monkeypatch.setattr(datacube, 'zarr', None)
+    with DataCube(str(tmp_path / 'cube'), range(2), (1, 2, 2), np.int16, -1) as cube:
+        cube.write(1, np.ones((1, 2, 2), dtype=np.int16))
+
+    assert (tmp_path / 'cube' / 'cube.npy').exists()
+    cube = open_cube(str(tmp_path / 'cube'))
+    assert isinstance(cube.data, np.memmap)
+    assert cube.read().tolist() == [[[[-1, -1], [-1, -1]]], [[[1, 1], [1, 1]]]]
+
+
+def test_median_and_percentile(tmp_path):
+    with DataCube(str(tmp_path / 'cube'), range(4), (1, 1, 3), np.int16, -9999) as cube:
+        cube.write(0, np.array([[[1, 10, -9999]]], dtype=np.int16))
+        cube.write(1, np.array([[[2, -9999, -9999]]], dtype=np.int16))
+        cube.write(2, np.array([[[100, 30, -9999]]], dtype=np.int16))
+
+        assert cube.composite('median', nodata=-9999, dtype=np.int16).tolist() == [[[2, 20, -9999]]]
+        assert cube.composite('percentile', nodata=-9999, q=0).tolist() == [[[1, 10, -9999]]]
+        assert cube.composite('percentile', nodata=-9999, q=100, window=rasterio.windows.Window(1, 0, 2, 1)).tolist() == [[[30, -9999]]]
+
+
+def test_best_pixel(tmp_path):
+    cube = DataCube(str(tmp_path / 'cube'), range(3), (2, 1, 3), np.int16, -9999)
+    scores = DataCube(str(tmp_path / 'scores'), range(3), (1, 1, 3), np.float32, np.nan)
+    cube.write(0, np.array([[[1, 1, -9999]], [[1, 1, -9999]]], dtype=np.int16))
+    scores.write(0, np.array([[[0.3, 0.1, 0.0]]], dtype=np.float32))
+    cube.write(1, np.array([[[2, -9999, -9999]], [[2, 2, -9999]]], dtype=np.int16))
+    scores.write(1, np.array([[[0.2, 0.0, 0.0]]], dtype=np.float32))
+
+    best = cube.composite('best', nodata=-9999, dtype=np.int16, scores=scores)
+    assert best.tolist() == [[[2, 1, -9999]], [[2, 1, -9999]]], 'the invalid observations are never chosen'
+
+
+def test_unknown_compositing(tmp_path):
+    with DataCube(str(tmp_path / 'cube'), range(1), (1, 1, 1), np.int16, -9999) as cube:
+        with pytest.raises(Exception):
+            cube.composite('max', nodata=-9999)
+
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_percentile_matches_numpy(tmp_path):
+    rng = np.random.default_rng(3)
+    with DataCube(str(tmp_path / 'cube'), range(5), (2, 6, 6), np.int16, -9999) as cube:
+        for index in range(5):
+            bands = rng.integers(0, 1000, (2, 6, 6)).astype(np.int16)
+            bands[:, rng.random((6, 6)) < 0.8] = -9999
+            cube.write(index, bands)
+
+        stack = cube.read().astype(np.float64)
+        stack[stack == -9999] = np.nan
+        valid = ~np.isnan(stack).all((0, 1))
+        assert not valid.all()
+        for q in [0, 25, 50, 90, 100]:
+            result = cube.percentile(q, nodata=-9999)
+            np.testing.assert_allclose(result[:, valid], np.nanpercentile(stack, q, axis=0)[:, valid], rtol=1e-5)
+            assert (result[:, ~valid] == -9999).all()
@@ -0,0 +1,40 @@
+import time
+import threading
+
+from mosaic.downloader import RateLimiter, get_downloader
+
+
+def test_rate_limiter_spacing():
+    limiter = RateLimiter(rate_limit=0.05)
+
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    elapsed = time.monotonic() - start
+
+    # the first token is available immediately, the other 4 are spaced by rate_limit
+    assert elapsed >= 4*0.05*0.9, 'RateLimiter must space consecutive requests'
+
+
+def test_rate_limiter_shared_between_threads():
+    limiter = RateLimiter(rate_limit=0.05)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=limiter.acquire) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    assert elapsed >= 4*0.05*0.9, 'RateLimiter must be shared by all the threads'
+
+
+def test_get_downloader_is_shared():
+    assert get_downloader(1, 4) is get_downloader(1, 4)
+    assert get_downloader(1, 4) is not get_downloader(1, 2)
+
+
+def test_limiter_shared_between_downloaders():
+    assert get_downloader(1, 4).limiter is get_downloader(1, 2).limiter
+    assert get_downloader(1, 4).limiter is not get_downloader(2, 4).limiter
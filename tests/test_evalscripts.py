@@ -0,0 +1,37 @@
+import pytest
+from mosaic import evalscripts
+
+
+def test_sentinel2_all_bands():
+    assert '"B01","B02","B03","B04","B05","B06","B07","B08","B8A","B09","B10","B11","B12","dataMask"' in evalscripts.SENTINEL2
+    assert 'bands: 14,' in evalscripts.SENTINEL2
+
+
+def test_sentinel2_band_subset():
+    evalscript = evalscripts.sentinel2(["B08", "B02", "B04", "B02"])
+    assert 'bands: ["B02","B04","B08","dataMask"]' in evalscript
+    assert 'bands: 4,' in evalscript
+    assert 'sample.B03' not in evalscript
+
+
+def test_sentinel2_unknown_band():
+    with pytest.raises(Exception):
+        evalscripts.sentinel2(["B02", "B13"])
+
+
+def test_cloud_bands():
+    assert len(evalscripts.CLOUD_BANDS) == 10
+    assert evalscripts.sort_bands(evalscripts.CLOUD_BANDS) == evalscripts.CLOUD_BANDS
+
+
+def test_sentinel2_server_cloud_mask():
+    evalscript = evalscripts.sentinel2(["B02"], cloud_mask="CLP", cloud_threshold=0.4)
+    assert 'bands: ["B02","dataMask","CLP"]' in evalscript
+    assert 'bands: 2,' in evalscript
+    assert 'sample.dataMask * (sample.CLP <= 102 ? 1 : 0)' in evalscript
+
+    evalscript = evalscripts.sentinel2(["B02"], cloud_mask="CLM")
+    assert 'sample.dataMask * (sample.CLM == 0 ? 1 : 0)' in evalscript
+
+    with pytest.raises(Exception):
+        evalscripts.sentinel2(["B02"], cloud_mask="SCL")
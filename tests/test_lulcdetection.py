@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from mosaic import lulcdetection
+
+
+class BoxFilter:
+    """
+    Stand-in for the Dynamic World model: a 3 x 3 mean of the bands, so that each pixel depends on its neighbours.
+    """
+    def predict(self, image):
+        padded = np.pad(image.astype(np.float32), ((1, 1), (1, 1), (0, 0)), mode='symmetric')
+        height, width = image.shape[:2]
+        return(sum(padded[i:i + height, j:j + width, :3] for i in range(3) for j in range(3))/9)
+
+
+@pytest.fixture
+def model(monkeypatch):
+    monkeypatch.setattr(lulcdetection, '_get_model', lambda: BoxFilter())
+
+
+@pytest.mark.parametrize('batch_size', [1, 3, 100])
+def test_tiled_inference_matches_full_image(model, batch_size):
+    image = np.random.default_rng(0).uniform(0, 1, size=(37, 50, 13)).astype(np.float32)
+
+    expected = lulcdetection.Inference().predict(image)
+    tiled = lulcdetection.Inference(tile_size=16, overlap=2, batch_size=batch_size).predict(image)
+
+    assert tiled.shape == (37, 50, 3)
+    np.testing.assert_allclose(tiled, expected, atol=1e-6)
+
+
+def test_masked_tiles_are_skipped(model):
+    image = np.random.default_rng(1).uniform(0, 1, size=(32, 48, 13)).astype(np.float32)
+    mask = np.zeros((32, 48), dtype=bool)
+    mask[20, 40] = True
+
+    calls = []
+    inference = lulcdetection.Inference(tile_size=16, overlap=2, batch_size=1)
+    predict = inference.model.predict
+    inference.model.predict = lambda image: calls.append(image.shape) or predict(image)
+
+    probs = inference.predict(image, mask)
+    assert len(calls) == 1
+    np.testing.assert_allclose(probs[16:, 32:], lulcdetection.Inference().predict(image)[16:, 32:], atol=1e-6)
+    assert (probs[:16] == 0).all()
+
+    assert inference.predict(image, np.zeros((32, 48), dtype=bool)) is None
@@ -0,0 +1,25 @@
+import datetime
+
+from mosaic.manifest import RunManifest
+
+
+def test_manifest_resume(tmp_path):
+    path = str(tmp_path / 'mosaic.tiff.manifest.json')
+    run = {'bbox': [46.00, -16.15, 46.05, -16.01], 'start': datetime.datetime(2020, 10, 5), 'n': 3}
+
+    manifest = RunManifest(path, run)
+    manifest.set('slots', '2020-10-05_2021-02-10', './image.tiff')
+
+    resumed = RunManifest(path, run)
+    assert resumed.get('slots', '2020-10-05_2021-02-10') == './image.tiff'
+    assert resumed.get('slots', '2021-02-10_2021-06-18') is None
+
+    resumed.remove()
+    assert RunManifest(path, run).get('slots', '2020-10-05_2021-02-10') is None
+
+
+def test_manifest_of_different_run_is_discarded(tmp_path):
+    path = str(tmp_path / 'mosaic.tiff.manifest.json')
+
+    RunManifest(path, {'n': 3}).set('tiles', 'key', 'tile.tiff')
+    assert RunManifest(path, {'n': 4}).get('tiles', 'key') is None
@@ -0,0 +1,168 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from mosaic.raster import merge, get_output_grid, get_window, write_cog
+
+
+def write_tile(path, bounds, data, nodata=None):
+    count, height, width = data.shape
+    transform = from_origin(bounds[0], bounds[3], (bounds[2] - bounds[0])/width, (bounds[3] - bounds[1])/height)
+    profile = dict(driver='GTiff', width=width, height=height, count=count, dtype=data.dtype, crs='EPSG:4326', transform=transform, nodata=nodata)
+    with rasterio.open(path, 'w', **profile) as file:
+        file.write(data)
+    return(str(path))
+
+
+def test_merge_adjacent_tiles(tmp_path):
+    left  = write_tile(tmp_path / 'left.tiff',  (0.0, 0.0, 1.0, 1.0), np.full((2, 10, 10), 1, dtype=np.int16))
+    right = write_tile(tmp_path / 'right.tiff', (1.0, 0.0, 2.0, 1.0), np.full((2, 10, 10), 2, dtype=np.int16))
+
+    output = merge([left, right], (0.0, 0.0, 2.0, 1.0), str(tmp_path / 'merged.tiff'), dstnodata=-9999, blocksize=16)
+    with rasterio.open(output) as file:
+        bands = file.read()
+        assert file.nodata == -9999
+
+    assert bands.shape == (2, 10, 20)
+    assert (bands[:, :, :10] == 1).all()
+    assert (bands[:, :, 10:] == 2).all()
+
+
+def test_merge_nodata_overlap(tmp_path):
+    data = np.full((1, 10, 10), 1, dtype=np.int16)
+    first = write_tile(tmp_path / 'first.tiff', (0.0, 0.0, 1.0, 1.0), data)
+    data = np.full((1, 10, 10), 2, dtype=np.int16)
+    data[:, :, :5] = -9999
+    second = write_tile(tmp_path / 'second.tiff', (0.0, 0.0, 1.0, 1.0), data, nodata=-9999)
+
+    output = merge([first, second], (0.0, 0.0, 1.5, 1.0), str(tmp_path / 'merged.tiff'), dstnodata=-9999)
+    with rasterio.open(output) as file:
+        bands = file.read()
+
+    assert (bands[:, :, :5] == 1).all(), 'nodata pixels must not overwrite valid pixels'
+    assert (bands[:, :, 5:10] == 2).all()
+    assert (bands[:, :, 10:] == -9999).all(), 'pixels not covered by any image must be nodata'
+
+
+def test_tile_writer_applies_data_mask(tmp_path):
+    from sentinelhub import BBox, BBoxSplitter, CRS, bbox_to_dimensions
+    from mosaic.raster import TileWriter
+
+    bbox = (46.00, -16.15, 46.05, -16.01)
+    tiles = BBoxSplitter([BBox(bbox, crs=CRS.WGS84)], crs=CRS.WGS84, split_shape=(2, 2)).get_bbox_list()
+
+    output = str(tmp_path / 'output.tiff')
+    with TileWriter(output, bbox, 10, nodata=-9999, blocksize=64) as writer:
+        for idx, tile in enumerate(tiles):
+            width, height = bbox_to_dimensions(tile, resolution=10)
+            data = np.full((3, height, width), idx + 1, dtype=np.int16)
+            data[-1] = 1
+            if(idx == 0):
+                data[-1] = 0  # first tile fully masked
+            writer.write(write_tile(tmp_path / f'tile_{idx}.tiff', list(tile), data))
+
+    with rasterio.open(output) as file:
+        bands = file.read()
+        assert file.nodata == -9999
+        assert (file.width, file.height) == bbox_to_dimensions(BBox(bbox, crs=CRS.WGS84), resolution=10)
+
+    assert bands.shape[0] == 2, 'the dataMask band must not be written'
+    assert set(np.unique(bands)) == {-9999, 2, 3, 4}
+
+    transform, width, height = get_output_grid(bbox, 10)
+    rows, cols = get_window(list(tiles[0]), transform, width, height).toslices()
+    masked = np.zeros((height, width), dtype=bool)
+    masked[rows, cols] = True
+    assert (bands[:, masked] == -9999).sum() > 0.9*bands[:, masked].size
+    assert (bands[:, ~masked] != -9999).all(), 'only the masked tile is nodata'
+
+
+def test_tile_writer_covers_the_seams(tmp_path):
+    from sentinelhub import BBox, BBoxSplitter, CRS, bbox_to_dimensions
+    from mosaic.raster import TileWriter
+
+    bbox = (46.00, -16.15, 46.17, -16.01)
+    tiles = BBoxSplitter([BBox(bbox, crs=CRS.WGS84)], crs=CRS.WGS84, split_shape=(7, 5)).get_bbox_list()
+
+    output = str(tmp_path / 'output.tiff')
+    with TileWriter(output, bbox, 10, nodata=-9999, blocksize=64) as writer:
+        for idx, tile in enumerate(tiles):
+            width, height = bbox_to_dimensions(tile, resolution=10)
+            writer.write(write_tile(tmp_path / f'tile_{idx}.tiff', list(tile), np.ones((2, height, width), dtype=np.int16)))
+
+    with rasterio.open(output) as file:
+        bands = file.read()
+
+    assert (bands != -9999).all(), 'every pixel inside the tiles must be written'
+
+
+def test_get_windows(tmp_path):
+    from mosaic.raster import get_windows
+
+    path = tmp_path / 'tiled.tiff'
+    profile = dict(driver='GTiff', width=100, height=70, count=1, dtype='int16', crs='EPSG:4326', transform=from_origin(0, 1, 0.01, 0.01), tiled=True, blockxsize=16, blockysize=16)
+    with rasterio.open(path, 'w', **profile) as file:
+        assert len(list(get_windows(file, 2))) == 1
+
+        for budget in [100*32*2, 16*32*2]:
+            windows = list(get_windows(file, 2, budget))
+            assert sum(window.width*window.height for window in windows) == 100*70
+            assert all(window.width*window.height*2 <= budget for window in windows)
+            assert all(window.row_off % 16 == 0 and window.col_off % 16 == 0 for window in windows)
+
+
+def test_get_window():
+    transform, width, height = get_output_grid((0, 0, 0.04, 0.02), 10)
+    assert (width, height) > (0, 0)
+
+    window = get_window((0, 0, 0.02, 0.02), transform, width, height)
+    assert (window.col_off, window.row_off, window.height) == (0, 0, height)
+    assert window.width == int(np.ceil(width/2))
+
+    # a partially covered pixel on each side is part of the window
+    left = (window.width - 0.5)*transform.a
+    window = get_window((left, 0, 0.04, 0.02), transform, width, height)
+    assert (window.col_off, window.width) == (int(np.ceil(width/2)) - 1, width - int(np.ceil(width/2)) + 1)
+
+    window = get_window((-1, -1, 1, 1), transform, width, height)
+    assert (window.width, window.height) == (width, height)
+
+
+def test_tile_writer_without_tiles(tmp_path):
+    from mosaic.raster import TileWriter
+
+    output = str(tmp_path / 'output.tiff')
+    with TileWriter(output, (46.00, -16.15, 46.05, -16.01), 10, nodata=-9999, dtype=np.float32, count=2, blocksize=64):
+        pass
+
+    with rasterio.open(output) as file:
+        bands = file.read()
+    assert bands.shape[0] == 2
+    assert (bands == -9999).all()
+
+
+def test_merge_different_nodata(tmp_path):
+    first = write_tile(tmp_path / 'first.tiff', (0.0, 0.0, 1.0, 1.0), np.full((1, 10, 10), 1, dtype=np.int16))
+    data = np.full((1, 10, 10), 2, dtype=np.int16)
+    data[:, :, :5] = 0
+    second = write_tile(tmp_path / 'second.tiff', (0.0, 0.0, 1.0, 1.0), data, nodata=0)
+
+    output = merge([first, second], (0.0, 0.0, 1.0, 1.0), str(tmp_path / 'merged.tiff'), dstnodata=-9999)
+    with rasterio.open(output) as file:
+        bands = file.read()
+
+    assert (bands[:, :, :5] == 1).all(), 'the nodata pixels of the second tile do not overwrite the first one'
+    assert (bands[:, :, 5:] == 2).all()
+
+
+def test_write_cog(tmp_path):
+    data = np.arange(1024*1024, dtype=np.int16).reshape(1, 1024, 1024)
+    tiff = write_tile(tmp_path / 'image.tiff', (0.0, 0.0, 1.0, 1.0), data, nodata=-9999)
+
+    output = write_cog(tiff, str(tmp_path / 'cog.tiff'), blocksize=256, resampling='average')
+    with rasterio.open(output) as file:
+        assert file.block_shapes[0] == (256, 256)
+        assert file.compression.name == 'deflate'
+        assert file.overviews(1) == [2, 4]
+        assert file.nodata == -9999
+        assert (file.read() == data).all()
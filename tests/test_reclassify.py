@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from mosaic.reclassify import Reclassification
+
+
+def test_worldcover_classes():
+    # same result as the sequential remapping used before the lookup table
+    bands = np.arange(256, dtype=np.uint8).reshape(1, 16, 16)
+    expected = bands.copy()
+    expected[expected == 0] = 240
+    for index, value in enumerate([10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100]):
+        expected[expected == value] = index
+
+    reclassification = Reclassification({10: 0, 20: 1, 30: 2, 40: 3, 50: 4, 60: 5, 70: 6, 80: 7, 90: 8, 95: 9, 100: 10}, nodata=240, src_nodata=0)
+    result = reclassification.apply(bands)
+    assert result.dtype == np.uint8
+    assert (result == expected).all()
+
+
+def test_mask_and_default():
+    reclassification = Reclassification({0: 10, 1: 20}, nodata=-1, dtype=np.int16, default=0)
+    bands = np.array([[[0, 1], [2, 1]]], dtype=np.int16)
+    mask = np.array([[True, True], [True, False]])
+
+    result = reclassification.apply(bands, mask=mask)
+    assert result.dtype == np.int16
+    assert result.tolist() == [[[10, 20], [0, -1]]]
+
+
+def test_signed_values():
+    reclassification = Reclassification({-9999: 0}, nodata=0, dtype=np.int16)
+    bands = np.array([-9999, -1, 5], dtype=np.int16)
+    assert reclassification.apply(bands).tolist() == [0, -1, 5]
+
+
+def test_unsupported_type():
+    with pytest.raises(Exception):
+        Reclassification({}, nodata=0).apply(np.zeros(3, dtype=np.int32))
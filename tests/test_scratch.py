@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+from mosaic.scratch import Scratch, get_scratch
+from mosaic.utils import prefetch
+
+
+def test_scratch_is_removed(tmp_path):
+    with Scratch(str(tmp_path)) as scratch:
+        path = scratch.path('image.tiff')
+        open(path, 'w').close()
+        assert os.path.dirname(path) != str(tmp_path)
+    assert not os.path.exists(scratch.folder)
+    assert os.listdir(tmp_path) == []
+
+
+def test_resumable_scratch_is_kept_on_failure(tmp_path):
+    output = str(tmp_path / 'mosaic.tiff')
+    with pytest.raises(Exception):
+        with get_scratch(output, resume=True) as scratch:
+            open(scratch.path('image.tiff'), 'w').close()
+            raise Exception('interrupted')
+    assert os.path.exists(scratch.path('image.tiff'))
+
+    with get_scratch(output, resume=True) as resumed:
+        assert resumed.folder == scratch.folder
+        assert os.path.exists(resumed.path('image.tiff'))
+    assert not os.path.exists(scratch.folder)
+
+
+def test_reserve_within_budget(tmp_path):
+    with Scratch(str(tmp_path), budget=100) as scratch:
+        assert scratch.reserve('a', 60)
+        assert not scratch.reserve('b', 60)
+        assert scratch.reserve('b', 60, force=True)
+        scratch.release('a')
+        scratch.release('b')
+        assert scratch.reserve('c', 500), 'an intermediate larger than the budget is allowed alone'
+
+
+def test_prefetch_backpressure(tmp_path):
+    consumed = []
+    with Scratch(str(tmp_path), budget=100) as scratch:
+        def reserve(item, force):
+            return(scratch.reserve(item, 60, force))
+
+        for item, result in prefetch(lambda item: scratch.used, ['a', 'b', 'c'], depth=2, reserve=reserve):
+            # a single image of 60 bytes fits in the budget, the next one is fetched after the release
+            assert scratch.used == 60
+            consumed.append(item)
+            scratch.release(item)
+
+    assert consumed == ['a', 'b', 'c']
@@ -0,0 +1,11 @@
+import datetime
+
+from mosaic.sentinel1 import group_dates
+
+
+def test_group_dates():
+    start = datetime.datetime(2021, 1, 1, 10)
+    dates = [start, start + datetime.timedelta(seconds=25), start + datetime.timedelta(days=12), start + datetime.timedelta(days=12, minutes=30)]
+    assert group_dates(dates) == [0, 0, 1, 1]
+    assert group_dates(dates, timedelta=datetime.timedelta(seconds=10)) == [0, 1, 2, 3]
+    assert group_dates([]) == []
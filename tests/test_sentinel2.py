@@ -0,0 +1,79 @@
+import datetime
+import zlib
+from pathlib import Path
+import numpy as np
+import rasterio
+from rasterio.transform import from_bounds
+
+import mosaic.sentinel2
+from mosaic.downloader import Downloader
+
+
+def test_min_observations_stops_after_a_covered_slot(tmp_path, monkeypatch):
+    requests = []
+
+    # every tile is fully valid: one band and the dataMask
+    def fetch(self, sh_request):
+        payload = sh_request.download_list[0].post_values
+        bounds, width, height = payload['input']['bounds']['bbox'], payload['output']['width'], payload['output']['height']
+        requests.append(bounds)
+        tiff = Path(sh_request.data_folder) / sh_request.get_filename_list()[0]
+        tiff.parent.mkdir(parents=True, exist_ok=True)
+        profile = dict(driver='GTiff', width=width, height=height, count=2, dtype='int16', crs='EPSG:4326', transform=from_bounds(*bounds, width, height))
+        with rasterio.open(tiff, 'w', **profile) as file:
+            file.write(np.ones((2, height, width), dtype=np.int16))
+        return(str(tiff))
+    monkeypatch.setattr(Downloader, '_fetch', fetch)
+
+    output = str(tmp_path / 'mosaic.tiff')
+    mosaic.sentinel2.mosaic(bbox=(46.00, -16.15, 46.06, -16.01), start=datetime.datetime(2021, 1, 1), end=datetime.datetime(2021, 4, 1), n=3, output=output, split_shape=(10, 10), mask_clouds=False, bands=['B04'], rate_limit=0, min_observations=1, scratch_dir=str(tmp_path / 'scratch'))
+
+    assert len(requests) == 100, 'the slots after the first one are not requested'
+    with rasterio.open(output) as file:
+        assert (file.read() == 1).all()
+
+
+def test_best_pixel_resume(tmp_path, monkeypatch):
+    # the tiles are random but the same for the same bounds and time slot
+    def fetch(self, sh_request):
+        payload = sh_request.download_list[0].post_values
+        bounds, width, height = payload['input']['bounds']['bbox'], payload['output']['width'], payload['output']['height']
+        slot = payload['input']['data'][0]['dataFilter']['timeRange']['from']
+        if(slot in fail):
+            raise Exception('interrupted')
+        rng = np.random.default_rng(zlib.crc32(repr((bounds, slot)).encode()))
+        tiff = Path(sh_request.data_folder) / sh_request.get_filename_list()[0]
+        tiff.parent.mkdir(parents=True, exist_ok=True)
+        data = rng.integers(1, 10000, size=(11, height, width)).astype(np.int16)
+        data[-1] = 1
+        profile = dict(driver='GTiff', width=width, height=height, count=11, dtype='int16', crs='EPSG:4326', transform=from_bounds(*bounds, width, height))
+        with rasterio.open(tiff, 'w', **profile) as file:
+            file.write(data)
+        return(str(tiff))
+    monkeypatch.setattr(Downloader, '_fetch', fetch)
+
+    # the cloud probability is the first band (B01)
+    class Inference:
+        def __init__(self, *args, **kwargs):
+            pass
+        def predict(self, image):
+            return(image[..., 0]*2)
+        def close(self):
+            pass
+    monkeypatch.setattr(mosaic.sentinel2.clouddetection, 'Inference', Inference)
+
+    kwargs = dict(bbox=(46.00, -16.15, 46.02, -16.13), start=datetime.datetime(2021, 1, 1), end=datetime.datetime(2021, 4, 1), n=3, split_shape=(2, 2), bands=['B04'], rate_limit=0, compositing='best', max_retry=1)
+    fail = []
+    mosaic.sentinel2.mosaic(output=str(tmp_path / 'uninterrupted.tiff'), **kwargs)
+
+    output = str(tmp_path / 'resumed.tiff')
+    fail = ['2021-03-02T00:00:00Z']
+    try:
+        mosaic.sentinel2.mosaic(output=output, resume=True, **kwargs)
+    except Exception:
+        pass
+    fail = []
+    mosaic.sentinel2.mosaic(output=output, resume=True, **kwargs)
+
+    with rasterio.open(str(tmp_path / 'uninterrupted.tiff')) as first, rasterio.open(output) as second:
+        assert (first.read() == second.read()).all(), 'the completed slots are ranked with their cloud probability'
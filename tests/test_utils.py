@@ -0,0 +1,87 @@
+import datetime
+
+import pytest
+
+import threading
+import time
+
+from mosaic.utils import backoff_retry, split_interval, prefetch
+
+
+def test_split_interval():
+    slots = split_interval(datetime.datetime(2021, 1, 1), datetime.datetime(2021, 1, 31), 3)
+    assert slots == [('2021-01-01', '2021-01-11'), ('2021-01-11', '2021-01-21'), ('2021-01-21', '2021-01-31')]
+
+
+def test_backoff_retry():
+    attempts = []
+
+    def flaky(value):
+        attempts.append(value)
+        if(len(attempts) < 3):
+            raise Exception('temporary error')
+        return(value)
+
+    assert backoff_retry(5, flaky, base_delay=0.001, value=7) == 7
+    assert len(attempts) == 3
+
+
+def test_backoff_retry_gives_up():
+    def failing():
+        raise Exception('permanent error')
+
+    with pytest.raises(Exception):
+        backoff_retry(2, failing, base_delay=0.001)
+
+
+def test_plan_split_shape():
+    from sentinelhub import BBox, BBoxSplitter, CRS, bbox_to_dimensions
+    from mosaic.utils import plan_split_shape
+
+    # the default bounding box of the CLI fits in a single request
+    assert plan_split_shape((46.00, -16.15, 46.05, -16.01), 10) == (1, 1)
+
+    bbox = BBox((10.0, 40.0, 13.0, 43.0), crs=CRS.WGS84)
+    for tile_size in [None, 1000]:
+        split_shape = plan_split_shape(bbox, 10, tile_size=tile_size)
+        size = 2500 if tile_size is None else tile_size
+        for tile in BBoxSplitter([bbox], crs=CRS.WGS84, split_shape=split_shape).get_bbox_list():
+            width, height = bbox_to_dimensions(tile, resolution=10)
+            assert width <= size and height <= size
+
+
+def test_prefetch_order_and_depth():
+    started = []
+    consumed = []
+
+    def fetch(item):
+        started.append(item)
+        return(item*2)
+
+    for item, result in prefetch(fetch, range(6), depth=2):
+        time.sleep(0.02)
+        # at most `depth` items are fetched ahead of the one being consumed
+        assert len(started) <= item + 3
+        consumed.append((item, result))
+
+    assert consumed == [(i, i*2) for i in range(6)]
+
+
+def test_prefetch_runs_in_background():
+    threads = []
+    for item, thread in prefetch(lambda item: threading.current_thread(), range(2), depth=1):
+        threads.append(thread)
+    assert all(thread is not threading.current_thread() for thread in threads)
+
+    threads = [thread for item, thread in prefetch(lambda item: threading.current_thread(), range(2), depth=0)]
+    assert all(thread is threading.current_thread() for thread in threads)
+
+
+def test_prefetch_raises():
+    def fetch(item):
+        if(item == 1):
+            raise Exception('failed')
+        return(item)
+
+    with pytest.raises(Exception, match='failed'):
+        list(prefetch(fetch, range(3), depth=1))